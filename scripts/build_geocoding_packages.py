@@ -24,10 +24,13 @@ def importGeocodingDatabase(outputFileName, wofFileName, addressesFileName, high
     os.remove(outputFileName)
 
   with closing(sqlite3.connect('file:%s?mode=ro' % wofFileName, uri=True)) as wofDb:
-    with closing(sqlite3.connect(outputFileName)) as db:
+    with closing(sqlite3.connect(outputFileName, cached_statements=256)) as db:
       db.isolation_level = None
       db.execute("PRAGMA locking_mode=EXCLUSIVE")
       db.execute("PRAGMA synchronous=OFF")
+      db.execute("PRAGMA temp_store=MEMORY")
+      db.execute("PRAGMA cache_size=-524288")
+      db.execute("PRAGMA mmap_size=268435456")
       db.execute("PRAGMA page_size=4096")
       db.execute("PRAGMA encoding='UTF-8'")
 
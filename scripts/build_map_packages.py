@@ -9,11 +9,27 @@ import gzip
 import zlib
 import base64
 import sqlite3
+import hashlib
 import argparse
 import concurrent.futures
+import numpy as np
+from numba import njit
 from contextlib import closing
+
+# Parsing/serializing tiles dominates without the C++ protobuf backend (20x slower in pure Python)
+try:
+  from google.protobuf.pyext import _message
+  os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'cpp')
+except ImportError:
+  pass
 import utils.mbvtpackage_pb2 as mbvtpackage_pb2
 
+# Optional libdeflate bindings, roughly 2x faster than stdlib zlib at equal ratio
+try:
+  import deflate
+except ImportError:
+  deflate = None
+
 # Package URL template
 DEFAULT_PACKAGE_URL_TEMPLATE = 'FULL_PACKAGE_URL/{version}/{id}.mbtiles?appToken={{key}}'
 
@@ -23,41 +39,42 @@ DEFAULT_PACKAGE_VERSION = 1
 # Maximum zoom level used in offline packages
 MAX_ZOOMLEVEL = 14
 
+# Canonical full tile polygon, encoding assumes extent 4096
+FULL_TILE_GEOMETRY = (9, 255, 8448, 34, 0, 8703, 0, 0, 8704, 0, 0, 8704, 15)
+
 class PackageTileMask(object):
   def __init__(self, tileMaskStr):
     self.data = self._decodeTileMask(tileMaskStr)
-    self.rootNode = self._buildTileNode(list(self.data), (0, 0, 0))
+    self.rootNode = None
 
   def contains(self, tile):
+    if self.rootNode is None:
+      self.rootNode, index = self._buildTileNode(self.data, 0, (0, 0, 0))
     node = self._findTileNode(tile)
     if node is None:
       return False
     return node["inside"]
 
   def getTiles(self, maxZoom=None):
-    tiles = []
-    if self.data != []:
-      self._buildTiles(list(self.data), (0, 0, 0), maxZoom, tiles)
-    return tiles
+    if len(self.data) == 0:
+      return np.empty((0, 3), dtype=np.int32)
+    return _buildMaskTiles(self.data, -1 if maxZoom is None else maxZoom)
 
   def _decodeTileMask(self, tileMaskStr):
-    str = [c for c in base64.b64decode(tileMaskStr)]
-    data = []
-    for i in range(len(str) * 8):
-      val = (str[i // 8] >> (7 - i % 8)) & 1
-      data.append(val)
-    return data
-
-  def _buildTileNode(self, data, tile):
+    return np.unpackbits(np.frombuffer(base64.b64decode(tileMaskStr), dtype=np.uint8))
+
+  def _buildTileNode(self, data, index, tile):
     (zoom, x, y) = tile
-    subtiles = data.pop(0)
-    inside = data.pop(0)
+    subtiles = data[index]
+    inside = data[index + 1]
+    index += 2
     node = { "tile" : tile, "inside": inside, "subtiles": [] }
     if subtiles:
       for dy in range(0, 2):
         for dx in range(0, 2):
-          node["subtiles"].append(self._buildTileNode(data, (zoom + 1, x * 2 + dx, y * 2 + dy)))
-    return node
+          subnode, index = self._buildTileNode(data, index, (zoom + 1, x * 2 + dx, y * 2 + dy))
+          node["subtiles"].append(subnode)
+    return node, index
 
   def _findTileNode(self, tile):
     (zoom, x, y) = tile
@@ -73,126 +90,169 @@ class PackageTileMask(object):
         return parentNode
     return None
 
-  def _buildTiles(self, data, tile, maxZoom, tiles):
-    (zoom, x, y) = tile
-    submask = data.pop(0)
-    inside = data.pop(0)
+@njit(cache=True)
+def _buildMaskTiles(data, maxZoom):
+  # Iterative DFS: only mask nodes consume bits and they are visited in
+  # pre-order, so the bit cursor stays in sync; expanded full-coverage
+  # subtrees below mask leaves do not touch the cursor
+  capacity = 1024
+  tiles = np.empty((capacity, 3), dtype=np.int32)
+  count = 0
+  index = 0
+  stack = [(0, 0, 0, False)]
+  while len(stack) > 0:
+    zoom, x, y, expanded = stack.pop()
+    if expanded:
+      submask = False
+      inside = True
+    else:
+      submask = data[index] != 0
+      inside = data[index + 1] != 0
+      index += 2
     if inside:
-      tiles.append(tile)
+      if count == capacity:
+        capacity *= 2
+        newTiles = np.empty((capacity, 3), dtype=np.int32)
+        newTiles[:count] = tiles[:count]
+        tiles = newTiles
+      tiles[count, 0] = zoom
+      tiles[count, 1] = x
+      tiles[count, 2] = y
+      count += 1
     if submask:
-      for dy in range(0, 2):
-        for dx in range(0, 2):
-          self._buildTiles(data, (zoom + 1, x * 2 + dx, y * 2 + dy), maxZoom, tiles)
-    elif maxZoom is not None and inside:
-      for dy in range(0, 2):
-        for dx in range(0, 2):
-          self._buildAllTiles((zoom + 1, x * 2 + dx, y * 2 + dy), maxZoom, tiles)
-
-  def _buildAllTiles(self, tile, maxZoom, tiles):
-    (zoom, x, y) = tile
-    if zoom > maxZoom:
-      return
-    tiles.append(tile)
-    for dy in range(0, 2):
-      for dx in range(0, 2):
-        self._buildAllTiles((zoom + 1, x * 2 + dx, y * 2 + dy), maxZoom, tiles)
+      for dy in range(1, -1, -1):
+        for dx in range(1, -1, -1):
+          stack.append((zoom + 1, x * 2 + dx, y * 2 + dy, False))
+    elif inside and maxZoom >= 0 and zoom < maxZoom:
+      for dy in range(1, -1, -1):
+        for dx in range(1, -1, -1):
+          stack.append((zoom + 1, x * 2 + dx, y * 2 + dy, True))
+  return tiles[:count]
 
 def decodeCoordinates(data, scale):
-  vertices = []
-  verticesList = []
-  cx = 0
-  cy = 0
-  cmd = 0
-  length = 0
+  data = np.asarray(data, dtype=np.int64)
+  # Walk command headers, recording the parameter spans of MoveTo/LineTo runs.
+  # Each MoveTo vertex starts a new ring.
+  spans = []
+  ringBreaks = []
+  total = 0
   i = 0
   while i < len(data):
-    if length == 0:
-      cmdLength = data[i]
-      i += 1
-      length = cmdLength >> 3
-      cmd = cmdLength & 7
-      if length == 0:
-        continue
-
-    length -= 1
-    if cmd == 1 or cmd == 2:
+    cmdLength = int(data[i])
+    i += 1
+    length = cmdLength >> 3
+    cmd = cmdLength & 7
+    if (cmd == 1 or cmd == 2) and length > 0:
+      spans.append((i, length))
       if cmd == 1:
-        if vertices:
-          verticesList.append(vertices)
-          vertices = []
-      dx = data[i]
-      i += 1
-      dy = data[i]
-      i += 1
-      dx = ((dx >> 1) ^ (-(dx & 1)))
-      dy = ((dy >> 1) ^ (-(dy & 1)))
-      cx += dx
-      cy += dy
-      vertices.append((float(cx) / scale, float(cy) / scale))
-    elif cmd == 7:
-      pass
-  if vertices:
-    verticesList.append(vertices)
-  return verticesList
-
-def clippedVertices(vertices):
-  return [(max(min(x, 1.0), 0.0), max(min(y, 1.0), 0.0)) for x, y in vertices]
-
-def clippedVertexPairs(vertices):
-  if len(vertices) < 3:
+        ringBreaks.extend(range(total, total + length))
+      total += length
+      i += 2 * length
+  if total == 0:
     return []
-  vertices = clippedVertices(vertices)
-  vertexPairs = []
-  for i in range(0, len(vertices)):
-    j = (i + 1) % len(vertices)
-    if vertices[i] != vertices[j]:
-      vertexPairs.append((vertices[i], vertices[j]))
-  return vertexPairs
-
-def classifyVertexPair(vertexPair):
-  v0, v1 = vertexPair
-  if v0[0] in (0.0, 1.0) and v0[1] in (0.0, 1.0) and v0[0] == v1[0] and v0[1] == 1.0 - v1[1]:
-    return 'x%g' % v0[0]
-  if v0[1] in (0.0, 1.0) and v0[0] in (0.0, 1.0) and v0[1] == v1[1] and v0[0] == 1.0 - v1[0]:
-    return 'y%g' % v0[1]
-  return None
 
-def isDegenerateRing(vertices):
-  classes = [classifyVertexPair(vertexPair) for vertexPair in clippedVertexPairs(vertices)]
-  if None in classes:
-    return False
-  if len(set(classes)) < 3:
-    return True
-  ring = []
-  for v0, v1 in clippedVertexPairs(vertices):
-    if len(ring) < 1:
-      ring.append(v0)
-      ring.append(v1)
+  # Zigzag-decode all deltas at once, then integrate with cumsum
+  deltas = np.empty((total, 2), dtype=np.int64)
+  pos = 0
+  for start, length in spans:
+    deltas[pos:pos+length] = data[start:start+2*length].reshape(length, 2)
+    pos += length
+  vertices = np.cumsum((deltas >> 1) ^ -(deltas & 1), axis=0) / scale
+  return [ring for ring in np.split(vertices, [b for b in ringBreaks if b > 0]) if len(ring) > 0]
+
+# Vertex pair classes: 0 = left edge, 1 = right edge, 2 = bottom edge, 3 = top edge, -1 = inside
+@njit(cache=True)
+def _classifyVertexPair(x0, y0, x1, y1):
+  if (x0 == 0.0 or x0 == 1.0) and (y0 == 0.0 or y0 == 1.0) and x0 == x1 and y0 == 1.0 - y1:
+    return 0 if x0 == 0.0 else 1
+  if (y0 == 0.0 or y0 == 1.0) and (x0 == 0.0 or x0 == 1.0) and y0 == y1 and x0 == 1.0 - x1:
+    return 2 if y0 == 0.0 else 3
+  return -1
+
+@njit(cache=True)
+def _clippedVertexPairs(vertices):
+  n = vertices.shape[0]
+  if n < 3:
+    return np.empty((0, 4), dtype=np.float64)
+  clipped = np.empty((n, 2), dtype=np.float64)
+  for i in range(n):
+    clipped[i, 0] = max(min(vertices[i, 0], 1.0), 0.0)
+    clipped[i, 1] = max(min(vertices[i, 1], 1.0), 0.0)
+  vertexPairs = np.empty((n, 4), dtype=np.float64)
+  m = 0
+  for i in range(n):
+    j = (i + 1) % n
+    if clipped[i, 0] != clipped[j, 0] or clipped[i, 1] != clipped[j, 1]:
+      vertexPairs[m, 0] = clipped[i, 0]
+      vertexPairs[m, 1] = clipped[i, 1]
+      vertexPairs[m, 2] = clipped[j, 0]
+      vertexPairs[m, 3] = clipped[j, 1]
+      m += 1
+  return vertexPairs[:m]
+
+@njit(cache=True)
+def _collapsedRingSize(vertexPairs):
+  m = vertexPairs.shape[0]
+  ring = np.empty((2 * m + 2, 2), dtype=np.float64)
+  size = 0
+  for k in range(m):
+    if size < 1:
+      ring[0, 0] = vertexPairs[k, 0]
+      ring[0, 1] = vertexPairs[k, 1]
+      ring[1, 0] = vertexPairs[k, 2]
+      ring[1, 1] = vertexPairs[k, 3]
+      size = 2
+    elif size > 1 and ring[size - 2, 0] == vertexPairs[k, 2] and ring[size - 2, 1] == vertexPairs[k, 3]:
+      size -= 1
     else:
-      if len(ring) > 1 and ring[-2] == v1:
-        del ring[-1]
-      else:
-        ring.append(v1)
-  return len(ring) < 3
+      ring[size, 0] = vertexPairs[k, 2]
+      ring[size, 1] = vertexPairs[k, 3]
+      size += 1
+  return size
+
+@njit(cache=True)
+def _isDegenerateRing(vertices):
+  vertexPairs = _clippedVertexPairs(vertices)
+  classMask = 0
+  for k in range(vertexPairs.shape[0]):
+    cls = _classifyVertexPair(vertexPairs[k, 0], vertexPairs[k, 1], vertexPairs[k, 2], vertexPairs[k, 3])
+    if cls < 0:
+      return False
+    classMask |= 1 << cls
+  classCount = 0
+  for cls in range(4):
+    if classMask & (1 << cls):
+      classCount += 1
+  if classCount < 3:
+    return True
+  return _collapsedRingSize(vertexPairs) < 3
+
+@njit(cache=True)
+def _isFullRing(vertices):
+  vertexPairs = _clippedVertexPairs(vertices)
+  m = vertexPairs.shape[0]
+  classes = np.empty(m, dtype=np.int64)
+  for k in range(m):
+    cls = _classifyVertexPair(vertexPairs[k, 0], vertexPairs[k, 1], vertexPairs[k, 2], vertexPairs[k, 3])
+    if cls < 0:
+      return False
+    classes[k] = cls
+  # Look for a cyclic left/bottom/right/top or left/top/right/bottom sequence
+  found = False
+  for s in range(m):
+    c0, c1, c2, c3 = classes[s], classes[(s + 1) % m], classes[(s + 2) % m], classes[(s + 3) % m]
+    if c0 == 0 and c2 == 1 and ((c1 == 2 and c3 == 3) or (c1 == 3 and c3 == 2)):
+      found = True
+      break
+  if not found:
+    return False
+  return _collapsedRingSize(vertexPairs) > 3
+
+def isDegenerateRing(vertices):
+  return bool(_isDegenerateRing(np.asarray(vertices, dtype=np.float64).reshape(-1, 2)))
 
 def isFullRing(vertices):
-  classes = [classifyVertexPair(vertexPair) for vertexPair in clippedVertexPairs(vertices)]
-  if None in classes:
-    return False
-  order = "_".join(classes + classes)
-  if not ("x0_y0_x1_y1" in order or "x0_y1_x1_y0" in order):
-    return False
-  ring = []
-  for v0, v1 in clippedVertexPairs(vertices):
-    if len(ring) < 1:
-      ring.append(v0)
-      ring.append(v1)
-    else:
-      if len(ring) > 1 and ring[-2] == v1:
-        del ring[-1]
-      else:
-        ring.append(v1)
-  return len(ring) > 3
+  return bool(_isFullRing(np.asarray(vertices, dtype=np.float64).reshape(-1, 2)))
 
 def isFullPolygon(verticesList):
   if len(verticesList) < 1:
@@ -213,27 +273,25 @@ def optimizeTile(tileData):
   # This is important as Mapnik Vector Tile renderer creates redundant vertices
   # and equivalent polygons have different encodings.
   for layer in tile.layers:
-    index = 0
-    while index < len(layer.features):
-      feature = layer.features[index]
+    keepFeatures = []
+    for feature in layer.features:
       if feature.type == 3:
         verticesList = decodeCoordinates(feature.geometry, layer.extent)
         if isEmptyPolygon(verticesList):
-          del layer.features[index]
           continue
         if isFullPolygon(verticesList):
-          if layer.extent == 4096: # feature encoding assumes this extent
-            del feature.geometry[:]
-            feature.geometry.extend([9, 255, 8448, 34, 0, 8703, 0, 0, 8704, 0, 0, 8704, 15])
-      index += 1
+          if layer.extent == 4096:
+            feature.geometry[:] = FULL_TILE_GEOMETRY
+      keepFeatures.append(feature)
+    if len(keepFeatures) < len(layer.features):
+      del layer.features[:]
+      layer.features.extend(keepFeatures)
 
   # Remove empty layers
-  index = 0
-  while index < len(tile.layers):
-    if len(tile.layers[index].features) == 0:
-      del tile.layers[index]
-      continue
-    index += 1
+  keepLayers = [layer for layer in tile.layers if len(layer.features) > 0]
+  if len(keepLayers) < len(tile.layers):
+    del tile.layers[:]
+    tile.layers.extend(keepLayers)
 
   # Compress tile
   tileData = tile.SerializeToString()
@@ -241,7 +299,10 @@ def optimizeTile(tileData):
 
 def compressTile(tileData, zdict=None):
   if zdict is not None:
+    # libdeflate does not support preset dictionaries, keep zlib here
     compress = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+  elif deflate is not None:
+    return deflate.gzip_compress(tileData, 12)
   else:
     compress = zlib.compressobj(9, zlib.DEFLATED, 31, 9, zlib.Z_DEFAULT_STRATEGY)
   deflated = compress.compress(tileData)
@@ -251,12 +312,23 @@ def compressTile(tileData, zdict=None):
 def decompressTile(tileData, zdict=None):
   if zdict is not None:
     decompress = zlib.decompressobj(-15, zdict)
+  elif deflate is not None and tileData[0:2] == b'\x1f\x8b':
+    return deflate.gzip_decompress(tileData)
   else:
     decompress = zlib.decompressobj(47)
   inflated = decompress.decompress(tileData)
   inflated += decompress.flush()
   return inflated
 
+def _initTileWorker(zdict):
+  global _workerZDict
+  _workerZDict = zdict
+
+def _optimizeAndCompressTile(tileData):
+  if tileData[0:2] == b'\x1f\x8b':
+    tileData = decompressTile(tileData)
+  return compressTile(optimizeTile(tileData), _workerZDict)
+
 def loadZDict(packageId, zdictDir):
   if zdictDir is None:
     return None
@@ -272,10 +344,12 @@ def loadZDict(packageId, zdictDir):
 def extractTiles(packageId, tileMask, worldFileName, outputFileName, maxZoom=14, zdict=None):
   # Decode tilemask, create full list of tiles up to specified zoom level
   tiles = PackageTileMask(tileMask).getTiles(maxZoom)
-  tiles.reverse() # reverse tiles, for more optimal hit
 
   # Open input file
   with closing(sqlite3.connect('file:%s?mode=ro' % worldFileName, uri=True)) as packageDb:
+    packageDb.execute("PRAGMA mmap_size=8589934592")
+    packageDb.execute("PRAGMA cache_size=-262144")
+    packageDb.execute("PRAGMA temp_store=MEMORY")
     packageCursor = packageDb.cursor()
     
     # Open output file and prepare database
@@ -283,10 +357,12 @@ def extractTiles(packageId, tileMask, worldFileName, outputFileName, maxZoom=14,
       os.remove(outputFileName)
 
     with closing(sqlite3.connect(outputFileName)) as outputDb:
+      outputDb.isolation_level = None
       outputDb.execute("PRAGMA locking_mode=EXCLUSIVE")
       outputDb.execute("PRAGMA synchronous=OFF")
-      outputDb.execute("PRAGMA page_size=512")
+      outputDb.execute("PRAGMA page_size=4096")
       outputDb.execute("PRAGMA encoding='UTF-8'")
+      outputDb.execute("BEGIN")
 
       outputCursor = outputDb.cursor()
       outputCursor.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
@@ -306,32 +382,55 @@ def extractTiles(packageId, tileMask, worldFileName, outputFileName, maxZoom=14,
       if row:
         outputCursor.execute("INSERT INTO metadata(name, value) VALUES('nutikeysha1', ?)", (row[0],))
 
-      i = 0
-      firstTile = True
-      missingTiles = 0
-      # Process tiles
-      prevTileData = None
-      while i < len(tiles):
-        zoom, x, y = tiles[i]
-        packageCursor.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (zoom, x, y))
-        row = packageCursor.fetchone()
-        if not row:
-          missingTiles += 1
-        else:
-          tileData = bytes(row[0])
-          if tileData != prevTileData:
-            if tileData[0:2] == b'\x1f\x8b':
-              uncompressedTileData = decompressTile(tileData)
-            else:
-              uncompressedTileData = tileData
-            optimizedTileData = optimizeTile(uncompressedTileData)
-            compressedTileData = compressTile(optimizedTileData, zdict)
-          outputCursor.execute("INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, ?)", (zoom, x, y, compressedTileData))
-          prevTileData = tileData
-        i += 1
+      # Read all requested tiles with a single join against a temp key table,
+      # optimize+compress distinct payloads in a worker pool, buffered inserts.
+      # The pool is kept small as packages themselves are already processed in
+      # parallel.
+      packageCursor.execute("CREATE TEMP TABLE wanted_tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER)")
+      packageCursor.executemany("INSERT INTO wanted_tiles VALUES (?, ?, ?)", tiles.tolist())
+      packageCursor.execute("SELECT w.zoom_level, w.tile_column, w.tile_row, t.tile_data FROM wanted_tiles w JOIN tiles t ON t.zoom_level=w.zoom_level AND t.tile_column=w.tile_column AND t.tile_row=w.tile_row")
+      foundTiles = 0
+      insertRows = []
+      tileHashes = {}
+      compressedTileCache = {} # identical ocean/forest tiles repeat across the whole package
+      with concurrent.futures.ProcessPoolExecutor(max_workers=4, initializer=_initTileWorker, initargs=(zdict,)) as executor:
+        while True:
+          rows = packageCursor.fetchmany(500)
+          if len(rows) == 0:
+            break
+          foundTiles += len(rows)
+          newTileDatas = list({ tileData for zoom, x, y, tileData in rows if tileData not in compressedTileCache })
+          for tileData, compressedTileData in zip(newTileDatas, executor.map(_optimizeAndCompressTile, newTileDatas, chunksize=16)):
+            compressedTileCache[tileData] = compressedTileData
+          for zoom, x, y, tileData in rows:
+            compressedTileData = compressedTileCache[tileData]
+            insertRows.append((zoom, x, y, compressedTileData))
+            tileHashes[(zoom, x, y)] = hashlib.sha1(compressedTileData).digest()
+          while len(compressedTileCache) > 4096:
+            compressedTileCache.pop(next(iter(compressedTileCache)))
+          if len(insertRows) >= 1000:
+            outputCursor.executemany("INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, ?)", insertRows)
+            insertRows = []
+      if insertRows:
+        outputCursor.executemany("INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, ?)", insertRows)
+      missingTiles = len(tiles) - foundTiles
 
-      # Close output file
       outputCursor.execute("CREATE UNIQUE INDEX tiles_index ON tiles (zoom_level, tile_column, tile_row)");
+
+      # Drop tiles that are not needed: tiles equal to their parent tile with
+      # no remaining child tiles. Decided from the recorded content hashes,
+      # processing zoom levels top down so removals can cascade upwards.
+      deletedTiles = []
+      for zoom in range(maxZoom, 0, -1):
+        for z, x, y in [key for key in tileHashes if key[0] == zoom]:
+          if tileHashes.get((zoom - 1, x // 2, y // 2)) == tileHashes[(zoom, x, y)]:
+            if not any((zoom + 1, x * 2 + dx, y * 2 + dy) in tileHashes for dx in (0, 1) for dy in (0, 1)):
+              del tileHashes[(zoom, x, y)]
+              deletedTiles.append((zoom, x, y))
+      if deletedTiles:
+        outputCursor.executemany("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", deletedTiles)
+
+      # Close output file
       outputCursor.close()
       outputDb.commit()
 
@@ -339,33 +438,6 @@ def extractTiles(packageId, tileMask, worldFileName, outputFileName, maxZoom=14,
   with closing(sqlite3.connect(outputFileName)) as outputDb:
     outputDb.execute("VACUUM")
 
-def optimizeTiles(outputFileName):
-  # Drop tiles that are not needed
-  with closing(sqlite3.connect(outputFileName)) as outputDb:
-    outputDb.execute("PRAGMA locking_mode=EXCLUSIVE")
-    outputDb.execute("PRAGMA synchronous=OFF")
-    outputDb.execute("CREATE UNIQUE INDEX IF NOT EXISTS tiles_index ON tiles (zoom_level, tile_column, tile_row)");
-
-    # Harvest tiles
-    cursor1 = outputDb.cursor()
-    cursor2 = outputDb.cursor()
-    for zoom in range(MAX_ZOOMLEVEL, 0, -1):
-      # Find tiles at specified zoom levels equal to their parent tiles
-      cursor1.execute("SELECT t.tile_column, t.tile_row FROM tiles t, tiles s WHERE t.zoom_level=? AND s.zoom_level=?-1 AND t.tile_column/2=s.tile_column AND t.tile_row/2=s.tile_row AND t.tile_data=s.tile_data", (zoom, zoom))
-      for row in cursor1.fetchall():
-        # Now check that there are no child tiles. In that case the tile can be deleted
-        x, y = row
-        cursor2.execute("SELECT zoom_level FROM tiles WHERE zoom_level=?+1 AND (tile_column BETWEEN ?*2 AND ?*2+1) AND (tile_row BETWEEN ?*2 AND ?*2+1)", (zoom, x, x, y, y))
-        if not cursor2.fetchone():
-          cursor2.execute("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (zoom, x, y))
-    cursor2.close()
-    cursor1.close()
-    outputDb.commit()
-
-  # Vacuum
-  with closing(sqlite3.connect(outputFileName)) as outputDb:
-    outputDb.execute("VACUUM")
-
 def processPackage(package, outputDir, inputFileName, zdictDir=None):
   outputFileName = '%s/%s.mbtiles' % (outputDir, package['id'])
   if os.path.exists(outputFileName):
@@ -378,13 +450,23 @@ def processPackage(package, outputDir, inputFileName, zdictDir=None):
   try:
     zdict = loadZDict(package['id'], zdictDir)
     extractTiles(package['id'], package['tile_mask'], inputFileName, outputFileName, MAX_ZOOMLEVEL, zdict)
-    optimizeTiles(outputFileName)
   except:
     if os.path.isfile(outputFileName):
       os.remove(outputFileName)
     raise
   return outputFileName
 
+def _initPackagePool(outputDir, inputFileName, zdictDir):
+  global _poolArgs
+  _poolArgs = (outputDir, inputFileName, zdictDir)
+
+def _processPackageTask(package):
+  outputDir, inputFileName, zdictDir = _poolArgs
+  try:
+    return (package['id'], processPackage(package, outputDir, inputFileName, zdictDir), None)
+  except Exception as e:
+    return (package['id'], None, str(e))
+
 def main():
   parser = argparse.ArgumentParser()
   parser.add_argument(dest='template', help='template for packages.json')
@@ -407,15 +489,13 @@ def main():
       sys.exit(-1)
 
   os.makedirs(args.output, exist_ok=True)
-  with concurrent.futures.ProcessPoolExecutor() as executor:
-    results = { package['id']: executor.submit(processPackage, package, args.output, args.input, args.zdict) for package in packagesList }
-
   outputFileNames = {}
-  for packageId, result in results.items():
-    try:
-      outputFileNames[packageId] = result.result()
-    except Exception as e:
-      print('Package %s failed: %s' % (packageId, str(e)), file=sys.stderr)
+  with concurrent.futures.ProcessPoolExecutor(initializer=_initPackagePool, initargs=(args.output, args.input, args.zdict)) as executor:
+    for packageId, outputFileName, error in executor.map(_processPackageTask, packagesList, chunksize=4):
+      if error is not None:
+        print('Package %s failed: %s' % (packageId, error), file=sys.stderr)
+      else:
+        outputFileNames[packageId] = outputFileName
 
   packagesList = []
   for package in packagesTemplate['packages']:
@@ -4,6 +4,7 @@ import os
 import io
 import sys
 import json
+import orjson
 import gzip
 import argparse
 import tempfile
@@ -23,18 +24,26 @@ class GeocodeExporter(osmium.SimpleHandler):
     self.highwaysFile = highwaysFile
     self.categoryMap = categoryMap
     self.addressMap = { 'addr:housenumber': 'number', 'addr:postcode': 'zip', 'addr:street': 'street' }
-    self.tagList = tagList
+    self.tagList = [frozenset(tags.split('+')) for tags in tagList]
 
   def _get_nodes(self, nodes):
-    if len(nodes) == 0 or not all([node.location.valid() for node in nodes]):
-      return None
-    return [{ 'lat': node.location.lat, 'lon': node.location.lon } for node in nodes]
-
-  def _valid_item(self, item):
-    for tags in self.tagList:
-      if all([tag in item.tags for tag in tags.split('+')]):
-        return True
-    return False
+    result = []
+    for node in nodes:
+      location = node.location
+      if not location.valid():
+        return None
+      result.append({ 'lat': location.lat, 'lon': location.lon })
+    return result if len(result) > 0 else None
+
+  def _valid_item(self, tagKeys):
+    return any(tags <= tagKeys for tags in self.tagList)
+
+  def _get_names(self, item, tagKeys):
+    names = { 'default': item.tags['name'] }
+    for key in tagKeys:
+      if key.startswith('name:'):
+        names[key[5:]] = item.tags[key]
+    return names
 
   def _get_categories(self, item):
     categories = set()
@@ -52,15 +61,13 @@ class GeocodeExporter(osmium.SimpleHandler):
     return None if len(addr) == 0 else addr
 
   def node(self, n):
-    if self._valid_item(n) and n.location.valid():
+    tagKeys = { tag.k for tag in n.tags }
+    if self._valid_item(tagKeys) and n.location.valid():
       item = { '_id': 'node:%d' % n.id, '_type': 'venue' }
       center = { 'lat': n.location.lat, 'lon': n.location.lon }
       data = { 'center_point': center }
-      if 'name' in n.tags:
-        data['name'] = { 'default': n.tags['name'] }
-        for tag in n.tags:
-          if tag.k.startswith('name:'):
-            data['name'][tag.k[5:]] = tag.v 
+      if 'name' in tagKeys:
+        data['name'] = self._get_names(n, tagKeys)
       addr = self._get_address(n)
       if addr is not None:
         item['_type'] = 'address'
@@ -69,18 +76,18 @@ class GeocodeExporter(osmium.SimpleHandler):
       if categories is not None:
         data['category'] = categories
       item['data'] = data
-      self.addressFile.write(json.dumps(item, indent=None) + "\n")
+      self.addressFile.write(orjson.dumps(item) + b'\n')
 
   def way(self, w):
-    if self._valid_item(w) and len(w.nodes) > 0 and all([node.location.valid() for node in w.nodes]):
+    tagKeys = { tag.k for tag in w.tags }
+    valid = self._valid_item(tagKeys)
+    nodes = self._get_nodes(w.nodes) if valid or 'building' in tagKeys or 'highway' in tagKeys else None
+    if valid and nodes is not None:
       item = { '_id': 'way:%d' % w.id, '_type': 'venue' }
-      center = { 'lat': sum([node.location.lat for node in w.nodes]) / len(w.nodes), 'lon': sum([node.location.lon for node in w.nodes]) / len(w.nodes) }
+      center = { 'lat': sum([node['lat'] for node in nodes]) / len(nodes), 'lon': sum([node['lon'] for node in nodes]) / len(nodes) }
       data = { 'center_point': center }
-      if 'name' in w.tags:
-        data['name'] = { 'default': w.tags['name'] }
-        for tag in w.tags:
-          if tag.k.startswith('name:'):
-            data['name'][tag.k[5:]] = tag.v 
+      if 'name' in tagKeys:
+        data['name'] = self._get_names(w, tagKeys)
       addr = self._get_address(w)
       if addr is not None:
         item['_type'] = 'address'
@@ -89,17 +96,14 @@ class GeocodeExporter(osmium.SimpleHandler):
       if categories is not None:
         data['category'] = categories
       item['data'] = data
-      self.addressFile.write(json.dumps(item, indent=None) + "\n")
-    if 'building' in w.tags:
-      nodes = self._get_nodes(w.nodes)
-      if nodes is not None:
+      self.addressFile.write(orjson.dumps(item) + b'\n')
+    if nodes is not None:
+      if 'building' in tagKeys:
         item = { 'id': w.id, 'type': 'way', 'nodes': nodes }
-        self.buildingsFile.write(json.dumps(item, indent=None) + "\n")
-    elif 'highway' in w.tags:
-      nodes = self._get_nodes(w.nodes)
-      if nodes is not None:
+        self.buildingsFile.write(orjson.dumps(item) + b'\n')
+      elif 'highway' in tagKeys:
         item = { 'id': w.id, 'type': 'way', 'nodes': nodes }
-        self.highwaysFile.write(json.dumps(item, indent=None) + "\n")
+        self.highwaysFile.write(orjson.dumps(item) + b'\n')
 
 def importPackage(package, inputDir, outputDir, categoryMap, tagList):
   inputFileName = '%s/%s.osm.pbf' % (inputDir, package['id'])
@@ -113,9 +117,10 @@ def importPackage(package, inputDir, outputDir, categoryMap, tagList):
 
   print('Importing data for %s' % package['id'])
   try:
-    with closing(gzip.open(addressesFileName, mode='wt', encoding='utf-8')) as addressesFile:
-      with closing(gzip.open(buildingsFileName, mode='wt', encoding='utf-8')) as buildingsFile:
-        with closing(gzip.open(highwaysFileName, mode='wt', encoding='utf-8')) as highwaysFile:
+    # Intermediate files, low compression level trades a little size for speed
+    with closing(gzip.open(addressesFileName, mode='wb', compresslevel=3)) as addressesFile:
+      with closing(gzip.open(buildingsFileName, mode='wb', compresslevel=3)) as buildingsFile:
+        with closing(gzip.open(highwaysFileName, mode='wb', compresslevel=3)) as highwaysFile:
           exporter = GeocodeExporter(addressesFile, buildingsFile, highwaysFile, categoryMap, tagList)
           exporter.apply_file(inputFileName, locations=True)
   except:
@@ -125,6 +130,17 @@ def importPackage(package, inputDir, outputDir, categoryMap, tagList):
     raise
   return (addressesFileName, buildingsFileName, highwaysFileName)
 
+def _initImportPool(inputDir, outputDir, categoryMap, tagList):
+  global _poolArgs
+  _poolArgs = (inputDir, outputDir, categoryMap, tagList)
+
+def _importPackageTask(package):
+  inputDir, outputDir, categoryMap, tagList = _poolArgs
+  try:
+    return (package['id'], importPackage(package, inputDir, outputDir, categoryMap, tagList), None)
+  except Exception as e:
+    return (package['id'], None, str(e))
+
 def main():
   parser = argparse.ArgumentParser()
   parser.add_argument(dest='template', help='template for packages.json')
@@ -143,15 +159,14 @@ def main():
     packagesTemplate = json.loads(packagesFile.read())
   packagesFilter = args.packages.split(',') if args.packages is not None else None
 
-  with concurrent.futures.ProcessPoolExecutor() as executor:
-    results = { package['id']: executor.submit(importPackage, package, args.input, args.output, categoryMap, tagList) for package in packagesTemplate['packages'] if packagesFilter is None or package['id'] in packagesFilter }
-
+  packagesList = [package for package in packagesTemplate['packages'] if packagesFilter is None or package['id'] in packagesFilter]
   outputFileNames = {}
-  for packageId, result in results.items():
-    try:
-      outputFileNames[packageId] = result.result()
-    except Exception as e:
-      print('Package %s failed: %s' % (packageId, str(e)), file=sys.stderr)
+  with concurrent.futures.ProcessPoolExecutor(initializer=_initImportPool, initargs=(args.input, args.output, categoryMap, tagList)) as executor:
+    for packageId, outputFileName, error in executor.map(_importPackageTask, packagesList, chunksize=4):
+      if error is not None:
+        print('Package %s failed: %s' % (packageId, error), file=sys.stderr)
+      else:
+        outputFileNames[packageId] = outputFileName
  
 if __name__ == "__main__":
   main()
@@ -7,14 +7,26 @@ import sys
 import json
 import gzip
 import zlib
+import mmap
 import base64
 import math
 import sqlite3
+import hashlib
 import argparse
+import functools
 import concurrent.futures
+import numpy as np
 import utils.pyproj_lite as pyproj
+from numba import njit
+from collections import deque
 from contextlib import closing
 
+# Optional libdeflate bindings, roughly 2x faster than stdlib zlib at equal ratio
+try:
+  import deflate
+except ImportError:
+  deflate = None
+
 # Package URL template
 DEFAULT_PACKAGE_URL_TEMPLATE = 'FULL_PACKAGE_URL/{version}/{id}.vtiles?appToken={{key}}'
 
@@ -32,7 +44,7 @@ MERCATOR_BOUNDS = ((-6378137 * math.pi, -6378137 * math.pi), (6378137 * math.pi,
 class PackageTileMask(object):
   def __init__(self, tileMaskStr):
     self.data = self._decodeTileMask(tileMaskStr)
-    self.rootNode = self._buildTileNode(list(self.data), (0, 0, 0))
+    self.rootNode, index = self._buildTileNode(self.data, 0, (0, 0, 0))
 
   def contains(self, tile):
     node = self._findTileNode(tile)
@@ -41,166 +53,281 @@ class PackageTileMask(object):
     return node["inside"]
 
   def getTiles(self, maxZoom=None):
-    tiles = []
-    if self.data != []:
-      self._buildTiles(list(self.data), (0, 0, 0), maxZoom, tiles)
-    return tiles
+    if len(self.data) == 0:
+      return np.empty((0, 3), dtype=np.int32)
+    return _buildMaskTiles(self.data, -1 if maxZoom is None else maxZoom)
 
   def _decodeTileMask(self, tileMaskStr):
-    str = [c for c in base64.b64decode(tileMaskStr)]
-    data = []
-    for i in range(len(str) * 8):
-      val = (str[i // 8] >> (7 - i % 8)) & 1
-      data.append(val)
-    return data
-
-  def _buildTileNode(self, data, tile):
-    (zoom, x, y) = tile
-    subtiles = data.pop(0)
-    inside = data.pop(0)
-    node = { "tile" : tile, "inside": inside, "subtiles": [] }
-    if subtiles:
-      for dy in range(0, 2):
-        for dx in range(0, 2):
-          node["subtiles"].append(self._buildTileNode(data, (zoom + 1, x * 2 + dx, y * 2 + dy)))
-    return node
+    return np.unpackbits(np.frombuffer(base64.b64decode(tileMaskStr), dtype=np.uint8))
+
+  def _buildTileNode(self, data, index, tile):
+    rootNode = None
+    stack = [(None, tile)]
+    while len(stack) > 0:
+      (parentNode, tile) = stack.pop()
+      (zoom, x, y) = tile
+      subtiles = data[index]
+      inside = data[index + 1]
+      index += 2
+      node = { "tile" : tile, "inside": inside, "subtiles": [] }
+      if parentNode is None:
+        rootNode = node
+      else:
+        parentNode["subtiles"].append(node)
+      if subtiles:
+        for dy in range(1, -1, -1):
+          for dx in range(1, -1, -1):
+            stack.append((node, (zoom + 1, x * 2 + dx, y * 2 + dy)))
+    return rootNode, index
 
   def _findTileNode(self, tile):
     (zoom, x, y) = tile
     if zoom == 0:
       return self.rootNode if tile == (0, 0, 0) else None
 
-    parentNode = self._findTileNode((zoom - 1, x >> 1, y >> 1))
-    if parentNode:
-      for node in parentNode["subtiles"]:
-        if node["tile"] == tile:
-          return node
-      if parentNode["inside"]:
-        return parentNode
-    return None
+    # Walk down from the root following the ancestor tiles of the target
+    node = self.rootNode
+    for level in range(1, zoom + 1):
+      subtile = (level, x >> (zoom - level), y >> (zoom - level))
+      for subnode in node["subtiles"]:
+        if subnode["tile"] == subtile:
+          node = subnode
+          break
+      else:
+        return node if node["inside"] else None
+    return node
 
-  def _buildTiles(self, data, tile, maxZoom, tiles):
-    (zoom, x, y) = tile
-    submask = data.pop(0)
-    inside = data.pop(0)
+@njit(cache=True)
+def _buildMaskTiles(data, maxZoom):
+  # Iterative DFS: only mask nodes consume bits and they are visited in
+  # pre-order, so the bit cursor stays in sync; expanded full-coverage
+  # subtrees below mask leaves do not touch the cursor
+  capacity = 1024
+  tiles = np.empty((capacity, 3), dtype=np.int32)
+  count = 0
+  index = 0
+  stack = [(0, 0, 0, False)]
+  while len(stack) > 0:
+    zoom, x, y, expanded = stack.pop()
+    if expanded:
+      submask = False
+      inside = True
+    else:
+      submask = data[index] != 0
+      inside = data[index + 1] != 0
+      index += 2
     if inside:
-      tiles.append(tile)
+      if count == capacity:
+        capacity *= 2
+        newTiles = np.empty((capacity, 3), dtype=np.int32)
+        newTiles[:count] = tiles
+        tiles = newTiles
+      tiles[count, 0] = zoom
+      tiles[count, 1] = x
+      tiles[count, 2] = y
+      count += 1
     if submask:
-      for dy in range(0, 2):
-        for dx in range(0, 2):
-          self._buildTiles(data, (zoom + 1, x * 2 + dx, y * 2 + dy), maxZoom, tiles)
-    elif maxZoom is not None and inside:
-      for dy in range(0, 2):
-        for dx in range(0, 2):
-          self._buildAllTiles((zoom + 1, x * 2 + dx, y * 2 + dy), maxZoom, tiles)
-
-  def _buildAllTiles(self, tile, maxZoom, tiles):
-    (zoom, x, y) = tile
-    if zoom > maxZoom:
-      return
-    tiles.append(tile)
-    for dy in range(0, 2):
-      for dx in range(0, 2):
-        self._buildAllTiles((zoom + 1, x * 2 + dx, y * 2 + dy), maxZoom, tiles)
+      for dy in range(1, -1, -1):
+        for dx in range(1, -1, -1):
+          stack.append((zoom + 1, x * 2 + dx, y * 2 + dy, False))
+    elif inside and maxZoom >= 0 and zoom < maxZoom:
+      for dy in range(1, -1, -1):
+        for dx in range(1, -1, -1):
+          stack.append((zoom + 1, x * 2 + dx, y * 2 + dy, True))
+  return tiles[:count]
+
+VALHALLA_ROW_WIDTHS = [int((VALHALLA_BOUNDS[1][0] - VALHALLA_BOUNDS[0][0]) / vTileSize) for vTileSize in VALHALLA_TILESIZES]
 
 def valhallaTilePath(vTile):
-  vTileSize = VALHALLA_TILESIZES[vTile[2]]
-  r = int((VALHALLA_BOUNDS[1][0] - VALHALLA_BOUNDS[0][0]) / vTileSize)
-  id = vTile[1] * r + vTile[0]
+  id = vTile[1] * VALHALLA_ROW_WIDTHS[vTile[2]] + vTile[0]
   splitId = []
   for i in range(0, max(1, vTile[2]) + 1):
-    splitId = ['%03d' % (id % 1000)] + splitId
-    id /= 1000
+    id, rem = divmod(id, 1000)
+    splitId = ['%03d' % rem] + splitId
   splitId = [str(vTile[2])] + splitId
   return '/'.join(splitId) + '.gph'
 
-def _calculateValhallaTiles(mTile, vZoom, transformer):
-  mTileSize = (MERCATOR_BOUNDS[1][0] - MERCATOR_BOUNDS[0][0]) / (1 << mTile[2])
-  vTileSize = VALHALLA_TILESIZES[vZoom]
-  mX0, mY0 = mTile[0] * mTileSize + MERCATOR_BOUNDS[0][0], mTile[1] * mTileSize + MERCATOR_BOUNDS[0][1]
-  mX1, mY1 = mX0 + mTileSize, mY0 + mTileSize
-  vY0, vX0 = transformer.transform(mX0, mY0)
-  vY1, vX1 = transformer.transform(mX1, mY1)
-  vTile0 = (vX0 - VALHALLA_BOUNDS[0][0]) / vTileSize, (vY0 - VALHALLA_BOUNDS[0][1]) / vTileSize
-  vTile1 = (vX1 - VALHALLA_BOUNDS[0][0]) / vTileSize, (vY1 - VALHALLA_BOUNDS[0][1]) / vTileSize
-  vTiles = []
-  for y in range(int(math.floor(vTile0[1])), int(math.ceil(vTile1[1]))):
-    for x in range(int(math.floor(vTile0[0])), int(math.ceil(vTile1[0]))):
-      vTiles.append((x, y, vZoom))
-  return vTiles
-
 def calculateValhallaTilesFromTileMask(tileMask):
-  vTiles = set()
-  mTiles = [(x, y, zoom) for zoom, x, y in PackageTileMask(tileMask).getTiles(TILEMASK_ZOOM)]
+  mTiles = [(x, y, zoom) for zoom, x, y in PackageTileMask(tileMask).getTiles(TILEMASK_ZOOM) if zoom >= TILEMASK_ZOOM]
+  if len(mTiles) == 0:
+    return []
+
+  # Transform all mercator tile corners in two batched calls, then do the
+  # valhalla tile range math vectorized per level
   transformer = pyproj.Transformer.from_crs('EPSG:3857', 'EPSG:4326')
-  for mTile in mTiles:
-    if mTile[2] < TILEMASK_ZOOM:
-      continue
-    for vZoom, vTileSize in enumerate(VALHALLA_TILESIZES):
-      for vTile in _calculateValhallaTiles(mTile, vZoom, transformer):
-        vTiles.add(vTile)
-  return sorted(list(vTiles))
+  mTileArray = np.array(mTiles, dtype=np.float64)
+  mTileSizes = (MERCATOR_BOUNDS[1][0] - MERCATOR_BOUNDS[0][0]) / (2.0 ** mTileArray[:, 2])
+  mX0 = mTileArray[:, 0] * mTileSizes + MERCATOR_BOUNDS[0][0]
+  mY0 = mTileArray[:, 1] * mTileSizes + MERCATOR_BOUNDS[0][1]
+  vY0, vX0 = transformer.transform(mX0.tolist(), mY0.tolist())
+  vY1, vX1 = transformer.transform((mX0 + mTileSizes).tolist(), (mY0 + mTileSizes).tolist())
+
+  vTileArrays = []
+  for vZoom, vTileSize in enumerate(VALHALLA_TILESIZES):
+    vTileX0 = np.floor((np.array(vX0) - VALHALLA_BOUNDS[0][0]) / vTileSize).astype(np.int64)
+    vTileY0 = np.floor((np.array(vY0) - VALHALLA_BOUNDS[0][1]) / vTileSize).astype(np.int64)
+    vTileX1 = np.ceil((np.array(vX1) - VALHALLA_BOUNDS[0][0]) / vTileSize).astype(np.int64)
+    vTileY1 = np.ceil((np.array(vY1) - VALHALLA_BOUNDS[0][1]) / vTileSize).astype(np.int64)
+    for i in range(len(mTiles)):
+      xx, yy = np.meshgrid(np.arange(vTileX0[i], vTileX1[i]), np.arange(vTileY0[i], vTileY1[i]), indexing='ij')
+      if xx.size > 0:
+        vTileArrays.append(np.stack([xx.ravel(), yy.ravel(), np.full(xx.size, vZoom, dtype=np.int64)], axis=1))
+  if len(vTileArrays) == 0:
+    return []
+  return [tuple(vTile) for vTile in np.unique(np.concatenate(vTileArrays), axis=0).tolist()]
+
+_compressorCache = {}
 
 def compressTile(tileData, zdict=None):
-  if zdict is not None:
-    compress = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
-  else:
-    compress = zlib.compressobj(9, zlib.DEFLATED, 31, 9, zlib.Z_DEFAULT_STRATEGY)
+  if zdict is None and deflate is not None:
+    return deflate.gzip_compress(tileData, 12)
+  # Initializing a level-9 compressor allocates ~256KB of state, so build one
+  # per dictionary and copy it per tile
+  cached = _compressorCache.get(id(zdict))
+  if cached is None or cached[0] is not zdict:
+    if zdict is not None:
+      baseCompress = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+      baseCompress = zlib.compressobj(9, zlib.DEFLATED, 31, 9, zlib.Z_DEFAULT_STRATEGY)
+    cached = _compressorCache[id(zdict)] = (zdict, baseCompress)
+  compress = cached[1].copy()
   deflated = compress.compress(tileData)
   deflated += compress.flush()
   return deflated
 
-def loadZDict(packageId, zdictDir):
+def resolveZDictFileName(packageId, zdictDir):
   if zdictDir is None:
     return None
   parts = packageId.split('-')
   fileNames = ["%s/%s.zdict" % (zdictDir, '-'.join(parts[:n])) for n in range(len(parts), 0, -1)]
   for fileName in fileNames:
     if os.path.exists(fileName):
-      with closing(io.open(fileName, 'rb')) as dictFile:
-        return dictFile.read()
+      return fileName
   print('Warning: Could not find dictionary for package %s!' % packageId)
   return None
 
-def extractTiles(packageId, tileMask, outputFileName, valhallaTileDir, zdict=None):
+@functools.lru_cache(maxsize=None)
+def loadZDict(zdictFileName):
+  if zdictFileName is None:
+    return None
+  with closing(io.open(zdictFileName, 'rb')) as dictFile:
+    return dictFile.read()
+
+_valhallaTileSets = {}
+
+def listValhallaTiles(valhallaTileDir):
+  # One directory walk per worker instead of a stat call per tile; the same
+  # tile dir is shared by every package this worker processes
+  existing = _valhallaTileSets.get(valhallaTileDir)
+  if existing is None:
+    existing = set()
+    for root, dirs, files in os.walk(valhallaTileDir):
+      for fileName in files:
+        existing.add(os.path.join(root, fileName))
+    _valhallaTileSets[valhallaTileDir] = existing
+  return existing
+
+def extractTiles(packageId, tileMask, outputFileName, valhallaTileDir, zdict=None, cacheDir=None, vacuum=False):
   if os.path.exists(outputFileName):
     os.remove(outputFileName)
 
   with closing(sqlite3.connect(outputFileName)) as outputDb:
+    outputDb.isolation_level = None
     outputDb.execute("PRAGMA locking_mode=EXCLUSIVE")
     outputDb.execute("PRAGMA synchronous=OFF")
-    outputDb.execute("PRAGMA page_size=512")
+    outputDb.execute("PRAGMA temp_store=MEMORY")
+    outputDb.execute("PRAGMA cache_size=-65536")
+    outputDb.execute("PRAGMA mmap_size=268435456")
+    outputDb.execute("PRAGMA page_size=4096")
     outputDb.execute("PRAGMA encoding='UTF-8'")
+    outputDb.execute("BEGIN")
 
     cursor = outputDb.cursor();
     cursor.execute("CREATE TABLE metadata (name TEXT, value TEXT)");
     cursor.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)");
-    cursor.execute("INSERT INTO metadata(name, value) VALUES('name', ?)", (packageId,))
-    cursor.execute("INSERT INTO metadata(name, value) VALUES('type', 'routing')")
-    cursor.execute("INSERT INTO metadata(name, value) VALUES('version', '1.0')")
-    cursor.execute("INSERT INTO metadata(name, value) VALUES('description', 'Nutiteq Valhalla routing package for ' || ?)", (packageId,))
-    cursor.execute("INSERT INTO metadata(name, value) VALUES('format', 'gph3')")
+    cursor.executemany("INSERT INTO metadata(name, value) VALUES(?, ?)", [
+      ('name', packageId),
+      ('type', 'routing'),
+      ('version', '1.0'),
+      ('description', 'Nutiteq Valhalla routing package for %s' % packageId),
+      ('format', 'gph3')
+    ])
     if zdict is not None:
       cursor.execute("INSERT INTO metadata(name, value) VALUES('shared_zlib_dict', ?)", (bytes(zdict),))
 
     vTiles = calculateValhallaTilesFromTileMask(tileMask)
-    for vTile in vTiles:
-      file = os.path.join(valhallaTileDir, valhallaTilePath(vTile))
-      if os.path.isfile(file):
-        with closing(io.open(file, 'rb')) as sourceFile:
-          compressedData = compressTile(sourceFile.read(), zdict)
-          cursor.execute("INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, ?)", (vTile[2], vTile[0], vTile[1], bytes(compressedData)));
-      else:
+    existingFiles = listValhallaTiles(valhallaTileDir)
+    zdictHash = hashlib.sha1(zdict).hexdigest() if zdict is not None else 'default'
+    def compressTileTask(vTile):
+      tilePath = valhallaTilePath(vTile)
+      file = os.path.join(valhallaTileDir, tilePath)
+      if file not in existingFiles:
         print('Warning: File %s does not exist!' % file)
+        return None
+      # Overlapping packages compress identical tiles; share the results
+      # through an on-disk cache keyed by dictionary and tile path
+      if cacheDir is not None:
+        cacheFileName = os.path.join(cacheDir, zdictHash, tilePath)
+        if os.path.isfile(cacheFileName):
+          with closing(io.open(cacheFileName, 'rb')) as cacheFile:
+            return (vTile[2], vTile[0], vTile[1], cacheFile.read())
+      with closing(io.open(file, 'rb')) as sourceFile:
+        # mmap the tile and let the compressor consume it via the buffer
+        # protocol, avoiding a full intermediate copy of the file
+        with closing(mmap.mmap(sourceFile.fileno(), 0, access=mmap.ACCESS_READ)) as sourceMap:
+          compressedData = compressTile(sourceMap, zdict)
+      if cacheDir is not None:
+        os.makedirs(os.path.dirname(cacheFileName), exist_ok=True)
+        tempFileName = '%s.%d.tmp' % (cacheFileName, os.getpid())
+        with closing(io.open(tempFileName, 'wb')) as cacheFile:
+          cacheFile.write(compressedData)
+        os.replace(tempFileName, cacheFileName)
+      return (vTile[2], vTile[0], vTile[1], compressedData)
+    # Compress in a small thread pool (zlib/libdeflate release the GIL and
+    # file reads overlap compression) while the main thread streams the
+    # inserts; a bounded window of pending tiles keeps memory flat and the
+    # sort keeps the index-friendly (zoom, column, row) insert order
+    vTiles = sorted(vTiles, key=lambda vTile: (vTile[2], vTile[0], vTile[1]))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      def compressedRows():
+        pending = deque()
+        for vTile in vTiles:
+          pending.append(executor.submit(compressTileTask, vTile))
+          if len(pending) >= 32:
+            row = pending.popleft().result()
+            if row is not None:
+              yield row
+        while len(pending) > 0:
+          row = pending.popleft().result()
+          if row is not None:
+            yield row
+      # Large tiles go through incremental blob I/O so the compressed payload
+      # is not duplicated while binding; small ones are batched normally
+      insertRows = []
+      for (zoom, x, y, tileData) in compressedRows():
+        if len(tileData) > 65536:
+          cursor.execute("INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, zeroblob(?))", (zoom, x, y, len(tileData)))
+          with outputDb.blobopen("tiles", "tile_data", cursor.lastrowid) as tileBlob:
+            tileBlob.write(tileData)
+        else:
+          insertRows.append((zoom, x, y, tileData))
+          if len(insertRows) >= 500:
+            cursor.executemany("INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, ?)", insertRows)
+            insertRows = []
+      if len(insertRows) > 0:
+        cursor.executemany("INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, ?)", insertRows)
 
     cursor.execute("CREATE UNIQUE INDEX tiles_index ON tiles (zoom_level, tile_column, tile_row)");
     cursor.close()
     outputDb.commit()
 
-  with closing(sqlite3.connect(outputFileName)) as outputDb:
-    outputDb.execute("VACUUM")
+  # The file was written linearly with a fixed page size, so a full rewrite
+  # is rarely worth the extra I/O
+  if vacuum:
+    with closing(sqlite3.connect(outputFileName)) as outputDb:
+      outputDb.execute("VACUUM")
 
-def processPackage(package, outputDir, tilesDir, zdictDir=None):
+def processPackage(package, outputDir, tilesDir, zdictFileName=None, vacuum=False):
   outputFileName = '%s/%s.vtiles' % (outputDir, package['id'])
   if os.path.exists(outputFileName):
     if not os.path.exists(outputFileName + "-journal"):
@@ -210,8 +337,8 @@ def processPackage(package, outputDir, tilesDir, zdictDir=None):
 
   print('Processing %s' % package['id'])
   try:
-    zdict = loadZDict(package['id'], zdictDir)
-    extractTiles(package['id'], package['tile_mask'], outputFileName, tilesDir, zdict)
+    zdict = loadZDict(zdictFileName)
+    extractTiles(package['id'], package['tile_mask'], outputFileName, tilesDir, zdict, '%s/.tile_cache' % outputDir, vacuum)
   except:
     if os.path.isfile(outputFileName):
       os.remove(outputFileName)
@@ -227,6 +354,7 @@ def main():
   parser.add_argument('--version', dest='version', default=DEFAULT_PACKAGE_VERSION, type=int, help='package version')
   parser.add_argument('--url_template', dest='url_template', default=DEFAULT_PACKAGE_URL_TEMPLATE, help='package URL template')
   parser.add_argument('--zdict', dest='zdict', default=None, help='directory for package .zdict files')
+  parser.add_argument('--vacuum', dest='vacuum', action='store_true', help='vacuum packages after building')
   args = parser.parse_args()
 
   with io.open(args.template, 'rt', encoding='utf-8') as packagesFile:
@@ -241,7 +369,9 @@ def main():
 
   os.makedirs(args.output, exist_ok=True)
   with concurrent.futures.ProcessPoolExecutor() as executor:
-    results = { package['id']: executor.submit(processPackage, package, args.output, args.input, args.zdict) for package in packagesList }
+    # Resolve dictionary files once in the parent so workers skip the
+    # per-package filesystem probing
+    results = { package['id']: executor.submit(processPackage, package, args.output, args.input, resolveZDictFileName(package['id'], args.zdict), args.vacuum) for package in packagesList }
 
   outputFileNames = {}
   for packageId, result in results.items():
@@ -1,7 +1,6 @@
 # Build RTree index for spr table of Whosinfirst database to perform fast bounding box queries.
 
 import argparse
-import json
 import sqlite3
 
 def main():
@@ -13,15 +12,10 @@ def main():
   db.execute("BEGIN")
   db.execute("DROP TABLE IF EXISTS spr_index")
   db.execute("CREATE VIRTUAL TABLE spr_index USING rtree(id, min_latitude, max_latitude, min_longitude, max_longitude)")
-  cursor1 = db.cursor()
-  cursor2 = db.cursor()
-  cursor1.execute("SELECT id, body FROM geojson")
-  for id, body in cursor1:
-    geojson = json.loads(body)
-    lng0, lat0, lng1, lat1 = geojson["bbox"]
-    cursor2.execute("INSERT INTO spr_index(id, min_latitude, max_latitude, min_longitude, max_longitude) VALUES(?, ?, ?, ?, ?)", (id, lat0, lat1, lng0, lng1))
-  cursor2.close()
-  cursor1.close()
+  # Extract the bounding boxes with the JSON1 extension instead of parsing
+  # each body in Python; the whole index builds in one statement
+  db.execute("""INSERT INTO spr_index(id, min_latitude, max_latitude, min_longitude, max_longitude)
+    SELECT id, json_extract(body, '$.bbox[1]'), json_extract(body, '$.bbox[3]'), json_extract(body, '$.bbox[0]'), json_extract(body, '$.bbox[2]') FROM geojson""")
   db.commit()
 
 if __name__ == "__main__":
@@ -7,27 +7,43 @@ import json
 import argparse
 import tempfile
 import subprocess
+import concurrent.futures
 import shapely.geometry
 import utils.pyproj_lite as pyproj
 import utils.tilemask as tilemask
 from contextlib import closing
 
-PACKAGE_BATCH_SIZE = 8 # optimal assuming 32GB of RAM
+def calculateBatchSize():
+  # Osmium keeps roughly 4GB per extract in flight; scale the batch with RAM
+  try:
+    totalBytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return max(8, int(totalBytes / (4 * 1024 * 1024 * 1024)))
+  except (ValueError, OSError):
+    return 8
+
+PACKAGE_BATCH_SIZE = calculateBatchSize()
+
+# Shared transformer instance, building one per package is wasteful
+TRANSFORMER = pyproj.Transformer.from_crs('EPSG:3857', 'EPSG:4326')
 
 def calculateExtract(package):
   geom = tilemask.tileMaskPolygon(package['tile_mask'])
 
-  transformer = pyproj.Transformer.from_crs('EPSG:3857', 'EPSG:4326')
+  transformer = TRANSFORMER
 
   if isinstance(geom, shapely.geometry.Polygon):
     geom = shapely.geometry.MultiPolygon([geom])
 
+  def transformRing(coords):
+    lats, lngs = transformer.transform([p[0] for p in coords], [p[1] for p in coords])
+    return list(zip(lngs, lats))
+
   ringsList = []
   for poly in geom.geoms:
     rings = []
-    rings.append([tuple(reversed(transformer.transform(*p))) for p in poly.exterior.coords])
+    rings.append(transformRing(poly.exterior.coords))
     for interior in poly.interiors:
-      rings.append([tuple(reversed(transformer.transform(*p))) for p in interior.coords])
+      rings.append(transformRing(interior.coords))
     ringsList.append(rings)
   return { 'output': '%s.osm.pbf' % package['id'], 'description': package['id'], 'multipolygon': ringsList }
 
@@ -45,8 +61,15 @@ def main():
   packagesList = [package for package in packagesTemplate['packages'] if packagesFilter is None or package['id'] in packagesFilter]
 
   os.makedirs(args.output, exist_ok=True)
-  for packageBatch in [packagesList[n:n+PACKAGE_BATCH_SIZE] for n in range(0, len(packagesList), PACKAGE_BATCH_SIZE)]:
-    config = { 'extracts': [calculateExtract(package) for package in packageBatch], 'directory': args.output }
+
+  # Precompute all extract polygons in parallel instead of leaving osmium
+  # idle while each batch is reprojected serially
+  with concurrent.futures.ProcessPoolExecutor() as executor:
+    extracts = list(executor.map(calculateExtract, packagesList, chunksize=4))
+
+  for n in range(0, len(packagesList), PACKAGE_BATCH_SIZE):
+    packageBatch = packagesList[n:n+PACKAGE_BATCH_SIZE]
+    config = { 'extracts': extracts[n:n+PACKAGE_BATCH_SIZE], 'directory': args.output }
     tempFile = tempfile.NamedTemporaryFile('wt', encoding='utf-8', suffix='.json', delete=False)
     try:
       tempFile.write(json.dumps(config))
@@ -1,6 +1,6 @@
 import json
-import pickle
 import shapely
+import shapely.wkb
 import shapely.prepared
 import shapely.geometry
 import sqlite3
@@ -22,12 +22,14 @@ class BuildingsLocator(object):
   def findGeometry(self, geometry):
     results = []
     bounds = calculateGeometryBounds(geometry)
+    # Build and prepare the query shape once instead of once per candidate row
+    preparedQuery = shapely.prepared.prep(shapely.geometry.shape(geometry))
     self.cursor.execute("SELECT bd.geometry, bd.data FROM buildings_data bd, buildings_index bi WHERE bi.min_longitude<=? AND bi.min_latitude<=? AND bi.max_longitude>=? AND bi.max_latitude>=? AND bi.id=bd.id", (bounds[0], bounds[1], bounds[2], bounds[3]))
     for row in self.cursor:
       try:
-        buildingShape = shapely.geometry.asShape(pickle.loads(row[0]))
-        if shapely.geometry.asShape(geometry).within(buildingShape):
-          data = pickle.loads(row[1])
+        buildingShape = shapely.wkb.loads(row[0])
+        if preparedQuery.within(buildingShape):
+          data = tuple(json.loads(row[1]))
           results.append(data)
       except:
         pass
@@ -35,7 +37,7 @@ class BuildingsLocator(object):
 
   def importGeometry(self, geometry, data):
     bounds = calculateGeometryBounds(geometry)
-    encodedGeometry = pickle.dumps(geometry)
-    encodedData = pickle.dumps(data)
+    encodedGeometry = shapely.wkb.dumps(shapely.geometry.shape(geometry))
+    encodedData = json.dumps(data)
     self.cursor.execute("INSERT INTO buildings_data(geometry, data) VALUES(?, ?)", (encodedGeometry, encodedData))
     self.cursor.execute("INSERT INTO buildings_index(id, min_latitude, max_latitude, min_longitude, max_longitude) VALUES(?, ?, ?, ?, ?)", (self.cursor.lastrowid, bounds[1], bounds[3], bounds[0], bounds[2]))
@@ -1,20 +1,69 @@
 import struct
 import shapely
+import numpy as np
+from numba import njit
 
 PRECISION = 1.0e6
 
+@njit(cache=True)
+def _encodeDeltas(deltas):
+  # Zig-zag + MSB-first varint encoding of a flat delta array; same byte
+  # stream as EncodingStream.encodeNumber, compiled for the coordinate loops
+  buf = np.empty(deltas.size * 10, dtype=np.uint8)
+  pos = 0
+  for i in range(deltas.size):
+    num = deltas[i]
+    if num < 0:
+      num = (-num << 1) - 1
+    else:
+      num = num << 1
+    shift = 7
+    while (num >> shift) > 0:
+      shift += 7
+    while shift > 0:
+      shift -= 7
+      val = (num >> shift) & 127
+      if shift > 0:
+        val += 128
+      buf[pos] = val
+      pos += 1
+  return buf[:pos]
+
+@njit(cache=True)
+def _decodeDeltas(data, offset, count):
+  nums = np.empty(count, dtype=np.int64)
+  for i in range(count):
+    num = 0
+    while True:
+      val = data[offset]
+      offset += 1
+      num = num + (val & 127)
+      if val < 128:
+        break
+      num = num << 7
+    if (num & 1) == 1:
+      num = -((num + 1) >> 1)
+    else:
+      num = num >> 1
+    nums[i] = num
+  return nums, offset
+
 class EncodingStream(object):
   def __init__(self, data=None):
     self.offset = 0
-    self.data = bytearray(data) if data else bytearray()
+    # Keep immutable input as-is; decoding never mutates the buffer and this
+    # avoids copying large feature blobs. Encoding converts on demand.
+    self.data = (data if isinstance(data, bytes) else bytearray(data)) if data else bytearray()
 
   def eof(self):
     return self.offset >= len(self.data)
 
   def getData(self):
-    return bytes(self.data)
+    return bytes(self.data) if isinstance(self.data, bytearray) else self.data
 
   def encodeNumber(self, num):
+    if not isinstance(self.data, bytearray):
+      self.data = bytearray(self.data)
     if num < 0:
       num = (-num << 1) - 1
     else:
@@ -127,19 +176,28 @@ class DeltaEncodingStream(EncodingStream):
 
   def encodeCoords(self, coords):
     self.encodeNumber(len(coords))
-    for coord in coords:
-      self.encodeCoord(coord)
+    if len(coords) == 0:
+      return
+    xy = np.round(np.asarray(coords, dtype=np.float64) * PRECISION).astype(np.int64)
+    deltas = np.empty_like(xy)
+    deltas[0] = xy[0] - self.prevCoord
+    deltas[1:] = xy[1:] - xy[:-1]
+    self.prevCoord[0] = int(xy[-1, 0])
+    self.prevCoord[1] = int(xy[-1, 1])
+    self.data += _encodeDeltas(deltas.ravel()).tobytes()
 
   def decodeCoords(self):
     n = self.decodeNumber()
-    coords = []
-    for i in range(0, n):
-      coord = self.decodeCoord()
-      coords.append(coord)
-    return coords
+    if n == 0:
+      return []
+    deltas, self.offset = _decodeDeltas(np.frombuffer(self.data, dtype=np.uint8), self.offset, n * 2)
+    xy = np.cumsum(deltas.reshape(n, 2), axis=0) + self.prevCoord
+    self.prevCoord[0] = int(xy[-1, 0])
+    self.prevCoord[1] = int(xy[-1, 1])
+    return [tuple(coord) for coord in (xy / PRECISION).tolist()]
 
   def encodeRings(self, rings):
-    encodeNumber(len(rings))
+    self.encodeNumber(len(rings))
     for ring in rings:
       self.encodeCoords(ring)
 
@@ -1,3 +1,4 @@
+import numpy as np
 import shapely.geometry
 import shapely.ops
 
@@ -73,12 +74,11 @@ def mergeGeometries(geometries):
 
 def calculateGeometryBounds(geometry):
   if geometry['type'].lower() == 'geometrycollection':
-    boundsList = [calculateGeometryBounds(subGeom) for subGeom in geometry['geometries']]
-    xs0 = [bounds[0] for bounds in boundsList]
-    ys0 = [bounds[1] for bounds in boundsList]
-    xs1 = [bounds[2] for bounds in boundsList]
-    ys1 = [bounds[3] for bounds in boundsList]
-    return (min(xs0), min(ys0), max(xs1), max(ys1)) if boundsList else None
+    boundsList = [bounds for bounds in (calculateGeometryBounds(subGeom) for subGeom in geometry['geometries']) if bounds is not None]
+    if not boundsList:
+      return None
+    arr = np.asarray(boundsList, dtype=np.float64)
+    return (float(arr[:, 0].min()), float(arr[:, 1].min()), float(arr[:, 2].max()), float(arr[:, 3].max()))
   points = []
   if geometry['type'].lower() == 'multipolygon':
     points = [point for rings in geometry['coordinates'] for ring in rings for point in ring]
@@ -88,9 +88,11 @@ def calculateGeometryBounds(geometry):
     points = [point for point in geometry['coordinates']]
   elif geometry['type'].lower() == 'point':
     points = [geometry['coordinates']]
-  xs = [float(point[0]) for point in points]
-  ys = [float(point[1]) for point in points]
-  return (min(xs), min(ys), max(xs), max(ys)) if points else None
+  if not points:
+    return None
+  xs = np.fromiter((point[0] for point in points), dtype=np.float64, count=len(points))
+  ys = np.fromiter((point[1] for point in points), dtype=np.float64, count=len(points))
+  return (float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()))
 
 def testClipBounds(bounds, clipBounds):
   if bounds is None or clipBounds is None:
@@ -109,16 +111,17 @@ def mergeBounds(bounds1, bounds2):
 def mergeBoundsLists(boundsList1, boundsList2):
   boundsList = boundsList1
   for bounds in boundsList2:
-    skip = False
-    for i in range(0, len(boundsList)):
-      bounds2 = boundsList[i]
-      if bounds[0] >= bounds2[0] and bounds[1] >= bounds2[1] and bounds[2] <= bounds2[2] and bounds[3] <= bounds2[3]:
-        skip = True
-        break
-      if bounds[0] <= bounds2[0] and bounds[1] <= bounds2[1] and bounds[2] >= bounds2[2] and bounds[3] >= bounds2[3]:
-        boundsList[i] = bounds
-        skip = True
-        break
-    if not skip:
-      boundsList.append(bounds)
+    if len(boundsList) > 0:
+      # One vectorized containment test against the whole list instead of a
+      # Python loop per existing bbox
+      arr = np.asarray(boundsList, dtype=np.float64)
+      inside = (bounds[0] >= arr[:, 0]) & (bounds[1] >= arr[:, 1]) & (bounds[2] <= arr[:, 2]) & (bounds[3] <= arr[:, 3])
+      contains = (bounds[0] <= arr[:, 0]) & (bounds[1] <= arr[:, 1]) & (bounds[2] >= arr[:, 2]) & (bounds[3] >= arr[:, 3])
+      either = inside | contains
+      if either.any():
+        i = int(np.argmax(either))
+        if not inside[i]:
+          boundsList[i] = bounds
+        continue
+    boundsList.append(bounds)
   return boundsList
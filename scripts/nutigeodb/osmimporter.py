@@ -3,10 +3,14 @@ import re
 import os
 import os.path
 import json
+import orjson
 import gzip
 import math
-import pickle
+import array
 import sqlite3
+import queue
+import threading
+import concurrent.futures
 import nutigeodb.encodingstream as encodingstream
 import nutigeodb.quadindex as quadindex
 import nutigeodb.woflocator as woflocator
@@ -16,17 +20,39 @@ from nutigeodb.geomutils import *
 from contextlib import closing
 from tqdm import tqdm
 
+try:
+  import rapidgzip # parallel gzip decompression, used when available
+except ImportError:
+  rapidgzip = None
+
 # Misc parameters
 SIMPLIFICATION_FACTOR = 1.0 / 256.0 # relative simplification factor
 CLASS_TABLE = { 'country': 1, 'region': 2, 'county': 3, 'locality': 4, 'neighbourhood': 5, 'street': 6, 'postcode': 7, 'name': 8, 'housenumber': 9 }
+CLASS_BITS = { type: 1 << bit for type, bit in CLASS_TABLE.items() }
 RANK_SCALE = 32767
 DEFAULT_EXTRA_POPULATION = 10
 EXTRA_POPULATION_TABLE = { 'street': 100, 'neighbourhood': 1000, 'locality': 10000, 'county': 100000, 'region': 1000000, 'country': 10000000 }
 SKIPPABLE_TOKEN_PREFIXES = ["l'"]
+NORMALIZE_TABLE = str.maketrans({ c: ' ' for c in ('"', '%', '\\', '*', '(', ')', '[', ']', '{', '}', '=', ';', ',', '.', '!', '?', '|', '`', '~', '^', '_') })
 MAX_GEOJSON_GEOMETRY_SIZE = 32 * 1024 * 1024
+NAME_LANG_PATTERN = re.compile('name:(.*)_x_preferred')
+ENTITY_ID_PATTERN = re.compile('.*[:](\\d+).*')
+PELIAS_PARSE_CHUNK_SIZE = 10000
+PELIAS_PARSE_WORKERS = 4
+
+def parsePeliasChunk(lines):
+  datas = []
+  for line in lines:
+    try:
+      datas.append(orjson.loads(line))
+    except:
+      pass
+  return datas
 
 class OSMImporter(object):
   class Token(object):
+    __slots__ = ('dbid', 'name', 'typemask', 'count', 'idf')
+
     def __init__(self, dbid, name):
       self.dbid = dbid
       self.name = name
@@ -35,6 +61,8 @@ class OSMImporter(object):
       self.idf = 0.0
 
   class Item(object):
+    __slots__ = ('type', 'name', 'extraNames', 'geometry', 'geomBoundsList', 'properties', 'population', 'dbids')
+
     def __init__(self, type):
       self.type = type
       self.name = None
@@ -50,6 +78,8 @@ class OSMImporter(object):
       return self.dbids.get(self.type, None)
 
   class Entity(object):
+    __slots__ = ('housenumber', 'geometry', 'dbids')
+
     def __init__(self):
       self.housenumber = None
       self.geometry = None
@@ -69,19 +99,28 @@ class OSMImporter(object):
     self.importCategories = importCategories
     self.importWOF = importWOF
     self.nameCounter = 0
+    self.entityIdCounter = 0
+    self.entityBatch = []
+    self.entityBatchKeys = set()
+    self.mergeIndex = {}
     self.categoryIds = {}
     self.streetsGeometry = {}
     self.buildingsGeometry = {}
     self.geomBounds = None
+    self.geomOriginSum = [0.0, 0.0]
+    self.geomFeatureCount = 0
     self.tokenAbbrevs = {}
+    self.tokenizeCache = {}
     self.toponyms = {}
     self.countryLangs = {}
     self.tokens = {}
     self.items = { 'country': {}, 'region': {}, 'county': {}, 'locality': {}, 'neighbourhood': {}, 'street': {}, 'postcode': {}, 'name': {} }
+    self.itemsByName = { 'country': {}, 'region': {}, 'county': {}, 'locality': {}, 'neighbourhood': {}, 'street': {}, 'postcode': {}, 'name': {} }
     self.itemId2Dbid = { 'country': {}, 'region': {}, 'county': {}, 'locality': {}, 'neighbourhood': {}, 'street': {}, 'postcode': {}, 'name': {} }
     self.dbid2ItemId = { 'country': {}, 'region': {}, 'county': {}, 'locality': {}, 'neighbourhood': {}, 'street': {}, 'postcode': {}, 'name': {} }
     with closing(io.open('%s/transliteration_table.json' % dataDir, 'rt', encoding='utf-8')) as f:
       self.transliterationTable = json.load(f)
+    self.transliterationTrans = str.maketrans(self.transliterationTable)
     with closing(io.open('%s/iso3_to_iso2_langs.json' % dataDir, 'rt', encoding='utf-8')) as f:
       self.iso3ToISO2Langs = json.load(f)
     #self.housenumRegexBuilder = regexbuilder.RegexBuilder()
@@ -102,30 +141,57 @@ class OSMImporter(object):
       for item in iterable:
         yield item
 
+  def progressGzip(self, f, fileName):
+    # Progress by compressed position, avoiding a counting pre-pass that would
+    # decompress the whole file twice
+    if not self.verbose:
+      for line in f:
+        yield line
+      return
+    rawFile = getattr(f.raw, 'fileobj', None)
+    if rawFile is None:
+      for line in tqdm(f):
+        yield line
+      return
+    with tqdm(total=os.path.getsize(fileName), unit='B', unit_scale=True) as progressBar:
+      for n, line in enumerate(f):
+        if (n & 16383) == 0:
+          progressBar.update(rawFile.tell() - progressBar.n)
+        yield line
+      progressBar.update(progressBar.total - progressBar.n)
+
+  def openGzipFile(self, fileName):
+    # Large read buffer keeps the line iterator fed with big decompressed chunks
+    if rapidgzip is not None:
+      return io.BufferedReader(rapidgzip.open(fileName, parallelization=os.cpu_count()), buffer_size=4 * 1024 * 1024)
+    return io.BufferedReader(gzip.open(fileName, 'rb'), buffer_size=4 * 1024 * 1024)
+
   def packCoordinates(self, coords):
-    return pickle.dumps(coords)
+    packed = array.array('d')
+    for coord in coords:
+      packed.extend(coord)
+    return packed.tobytes()
 
   def unpackCoordinates(self, packedCoords):
-    return pickle.loads(packedCoords)
+    unpacked = array.array('d')
+    unpacked.frombytes(packedCoords)
+    it = iter(unpacked)
+    return list(zip(it, it))
 
   def normalizeName(self, name):
-    for c in ('"', '%', '\\', '*', '(', ')', '[', ']', '{', '}', '=', ';', ',', '.', '!', '?', '|', '`', '~', '^', '_'):
-      name = name.replace(c, ' ')
-    return ' '.join([part for part in name.split() if part != ''])
+    return ' '.join(name.translate(NORMALIZE_TABLE).split())
 
   def tokenizeName(self, name):
+    words = self.tokenizeCache.get(name, None)
+    if words is not None:
+      return words
     words = []
-    for token in name.lower().split():
-      word = ''
-      for c in token:
-        if c in self.transliterationTable:
-          word += self.transliterationTable[c]
-        else:
-          word += c
+    for word in name.lower().translate(self.transliterationTrans).split():
       for prefix in SKIPPABLE_TOKEN_PREFIXES:
         if word.startswith(prefix):
           words.append(word[len(prefix):])
       words.append(word)
+    self.tokenizeCache[name] = words
     return words
 
   def normalizeHouseNumber(self, housenumber):
@@ -139,11 +205,13 @@ class OSMImporter(object):
     with closing(io.open(fname, 'rt', encoding='utf-8')) as f:
       for line in f:
         names = [name.strip() for name in line.split('|')]
-        for i in range(0, len(names)):
-          for j in range(0, len(names)):
-            if j != i:
-              tokenAbbrevs[names[j]] = list(set(tokenAbbrevs.get(names[j], []) + [names[i]]))
-    return tokenAbbrevs
+        if len(names) < 2:
+          continue
+        for i, name in enumerate(names):
+          abbrevs = tokenAbbrevs.setdefault(name, set())
+          abbrevs.update(names[:i])
+          abbrevs.update(names[i+1:])
+    return { name: list(abbrevs) for name, abbrevs in tokenAbbrevs.items() }
 
   def loadToponyms(self, lang):
     fname = '%s/dictionaries/%s/toponyms.txt' % (self.dataDir, lang)
@@ -153,9 +221,9 @@ class OSMImporter(object):
     with closing(io.open(fname, 'rt', encoding='utf-8')) as f:
       for line in f:
         names = line.split('|')
-        for i in range(1, len(names)):
-          name = names[0].lower()
-          toponyms[name] = toponyms.get(name, []) + [names[i]]
+        if len(names) < 2:
+          continue
+        toponyms.setdefault(names[0].lower(), []).extend(names[1:])
     return toponyms
 
   def mapCountryToLanguage(self, isoCountry):
@@ -174,6 +242,21 @@ class OSMImporter(object):
               self.countryLangs[country] = elems[1].lower()
     return self.countryLangs.get(isoCountry.lower(), None) if isoCountry else None
 
+  def estimateGeometrySize(self, geometry):
+    # Rough serialized size (~40 bytes per coordinate pair in GeoJSON); avoids
+    # dumping multi-MB geometries to a string just to measure them
+    if geometry is None:
+      return 0
+    if geometry['type'].lower() == 'geometrycollection':
+      return sum(self.estimateGeometrySize(subGeom) for subGeom in geometry['geometries'])
+    def countCoords(coords):
+      if not isinstance(coords, (list, tuple)) or len(coords) == 0:
+        return 0
+      if isinstance(coords[0], (list, tuple)):
+        return sum(countCoords(subCoords) for subCoords in coords)
+      return 1
+    return countCoords(geometry.get('coordinates', [])) * 40
+
   def calculateItemRank(self, item):
     rank = 1.0
     for parentType, parentDbid in item.dbids.items():
@@ -237,27 +320,40 @@ class OSMImporter(object):
 
   def storeFieldNames(self):
     cursor = self.db.cursor()
+    nameRows = []
+    nameTokenRows = []
     for type in CLASS_TABLE.keys():
       if type == 'housenumber':
         continue
+      typeId = CLASS_TABLE[type]
+      tokens = self.tokens
       for item in self.items[type].values():
-        if item.dbid is None:
+        itemDbid = item.dbid
+        if itemDbid is None:
           self.warning('Item %s missing id' % item.name)
           continue
         insertedValues = set()
         for lang, name in [(None, item.name)] + item.extraNames:
-          cursor.execute("INSERT INTO names(id, lang, name, type) VALUES(?, ?, ?, ?)", (item.dbid, lang, name, CLASS_TABLE[type]))
+          nameRows.append((itemDbid, lang, name, typeId))
           for tokenName in self.tokenizeName(name):
-            tokenKey = (tokenName, lang)
-            if tokenKey not in self.tokens:
-              tokenKey = (tokenName, None)
-            if tokenKey in self.tokens:
-              values = (item.dbid, self.tokens[tokenKey].dbid)
+            token = tokens.get((tokenName, lang), None) or tokens.get((tokenName, None), None)
+            if token is not None:
+              values = (itemDbid, token.dbid)
               if values not in insertedValues:
-                cursor.execute("INSERT INTO nametokens(name_id, token_id) VALUES(?, ?)", values)
+                nameTokenRows.append(values)
                 insertedValues.add(values)
             else:
               self.warning('Token %s missing' % tokenName)
+        if len(nameRows) >= 10000:
+          cursor.executemany("INSERT INTO names(id, lang, name, type) VALUES(?, ?, ?, ?)", nameRows)
+          nameRows = []
+        if len(nameTokenRows) >= 10000:
+          cursor.executemany("INSERT INTO nametokens(name_id, token_id) VALUES(?, ?)", nameTokenRows)
+          nameTokenRows = []
+    if nameRows:
+      cursor.executemany("INSERT INTO names(id, lang, name, type) VALUES(?, ?, ?, ?)", nameRows)
+    if nameTokenRows:
+      cursor.executemany("INSERT INTO nametokens(name_id, token_id) VALUES(?, ?)", nameTokenRows)
     cursor.close()
 
   def importMetadata(self):
@@ -271,14 +367,17 @@ class OSMImporter(object):
   def importTokens(self, name, type, lang):
     if lang is not None and lang not in self.tokenAbbrevs:
       self.tokenAbbrevs[lang] = self.loadTokenAbbrevs(lang)
+    typeBit = CLASS_BITS[type]
     for tokenName in self.tokenizeName(name):
       tokenKey = (tokenName, None)
       if lang is not None and tokenName in self.tokenAbbrevs[lang]:
         tokenKey = (tokenName, lang)
-      if tokenKey not in self.tokens:
-        self.tokens[tokenKey] = self.Token(len(self.tokens) + 1, tokenName)
-      self.tokens[tokenKey].typemask = self.tokens[tokenKey].typemask | (1 << CLASS_TABLE[type])
-      self.tokens[tokenKey].count += 1
+      token = self.tokens.get(tokenKey, None)
+      if token is None:
+        token = self.Token(len(self.tokens) + 1, tokenName)
+        self.tokens[tokenKey] = token
+      token.typemask |= typeBit
+      token.count += 1
 
   def storeTokens(self):
     totalCount = sum([token.count for token in self.tokens.values()])
@@ -286,12 +385,18 @@ class OSMImporter(object):
       token.idf = math.log(float(totalCount) / float(token.count))
     avgIDF = sum([token.idf / len(self.tokens) for token in self.tokens.values()])
     cursor = self.db.cursor()
+    tokenRows = []
     for tokenKey, token in self.tokens.items():
       tokenName, lang = tokenKey
-      cursor.execute("INSERT INTO tokens(id, token, idf, typemask) VALUES(?, ?, ?, ?)", (token.dbid, tokenName, token.idf / avgIDF, token.typemask))
+      tokenRows.append((token.dbid, tokenName, token.idf / avgIDF, token.typemask))
       for lang in self.tokenAbbrevs.keys():
         for tokenAbbrev in self.tokenAbbrevs[lang].get(tokenName, []):
-          cursor.execute("INSERT INTO tokens(id, token, idf, typemask) VALUES(?, ?, ?, ?)", (token.dbid, tokenAbbrev, token.idf / avgIDF, token.typemask))
+          tokenRows.append((token.dbid, tokenAbbrev, token.idf / avgIDF, token.typemask))
+      if len(tokenRows) >= 10000:
+        cursor.executemany("INSERT INTO tokens(id, token, idf, typemask) VALUES(?, ?, ?, ?)", tokenRows)
+        tokenRows = []
+    if tokenRows:
+      cursor.executemany("INSERT INTO tokens(id, token, idf, typemask) VALUES(?, ?, ?, ?)", tokenRows)
     cursor.close()
 
   def loadCategories(self, entityId):
@@ -307,11 +412,14 @@ class OSMImporter(object):
     if not self.importCategories:
       return
     cursor = self.db.cursor()
+    categoryRows = []
     for category in categories:
       if category not in self.categoryIds:
         cursor.execute("INSERT INTO categories(category) VALUES(?)", (category,))
         self.categoryIds[category] = cursor.lastrowid
-      cursor.execute("INSERT INTO entitycategories(entity_id, category_id) VALUES(?, ?)", (entityId, self.categoryIds[category]))
+      categoryRows.append((entityId, self.categoryIds[category]))
+    if categoryRows:
+      cursor.executemany("INSERT INTO entitycategories(entity_id, category_id) VALUES(?, ?)", categoryRows)
     cursor.close()
 
   def mapEntityParent(self, id, type):
@@ -327,9 +435,9 @@ class OSMImporter(object):
 
     geojson = self.wofLocator.findGeoJSON(id)
     for n in range(10, 4, -1):
-      if len(json.dumps(geojson['geometry'])) <= MAX_GEOJSON_GEOMETRY_SIZE:
+      if self.estimateGeometrySize(geojson['geometry']) <= MAX_GEOJSON_GEOMETRY_SIZE:
         break
-      geom = shapely.geometry.asShape(geojson['geometry'])
+      geom = shapely.geometry.shape(geojson['geometry'])
       geojson['geometry'] = shapely.geometry.mapping(geom.simplify(2.0**(-n), False))
     if geojson is None:
       self.warning('Failed to import WOF data for %s: %d' % (type, id))
@@ -367,7 +475,7 @@ class OSMImporter(object):
     # Extract translations and alternative names
     translations = []
     for key, val in properties.items():
-      match = re.match('name:(.*)_x_preferred', key)
+      match = NAME_LANG_PATTERN.match(key)
       if match:
         lang = self.iso3ToISO2Langs.get(match.group(1), None)
         if lang and isinstance(val, list) and len(val) > 0:
@@ -387,22 +495,22 @@ class OSMImporter(object):
     item.dbids[type] = dbid
 
     # Try to merge with existing record, based on name
-    for oldId, oldItem in self.items[type].items():
-      if oldItem.name == item.name and oldItem.extraNames == item.extraNames:
-        if not (item.population is None and oldItem.population is None):
-          oldItem.population = (oldItem.population or 0) + (item.population or 0)
-        if oldItem.geometry is not None and oldItem.geometry['type'].lower() == 'geometrycollection':
-          geoms1 = oldItem.geometry['geometries']
-        else:
-          geoms1 = [oldItem.geometry] if oldItem.geometry is not None else []
-        if item.geometry is not None and item.geometry['type'].lower() == 'geometrycollection':
-          geoms2 = item.geometry['geometries']
-        else:
-          geoms2 = [item.geometry] if item.geometry is not None else []
-        if len(geoms1 + geoms2) > 0:
-          oldItem.geometry = { 'type': 'GeometryCollection', 'geometries': geoms1 + geoms2 }
-        self.itemId2Dbid[type][id] = oldItem.dbid
-        return oldItem.dbid
+    oldItem = self.itemsByName[type].get((item.name, tuple(item.extraNames)), None)
+    if oldItem is not None:
+      if not (item.population is None and oldItem.population is None):
+        oldItem.population = (oldItem.population or 0) + (item.population or 0)
+      if oldItem.geometry is not None and oldItem.geometry['type'].lower() == 'geometrycollection':
+        geoms1 = oldItem.geometry['geometries']
+      else:
+        geoms1 = [oldItem.geometry] if oldItem.geometry is not None else []
+      if item.geometry is not None and item.geometry['type'].lower() == 'geometrycollection':
+        geoms2 = item.geometry['geometries']
+      else:
+        geoms2 = [item.geometry] if item.geometry is not None else []
+      if len(geoms1 + geoms2) > 0:
+        oldItem.geometry = { 'type': 'GeometryCollection', 'geometries': geoms1 + geoms2 }
+      self.itemId2Dbid[type][id] = oldItem.dbid
+      return oldItem.dbid
 
     # Extract full hierarchy of parents
     hierarchy = self.wofLocator.getHierarchy(id)
@@ -417,6 +525,7 @@ class OSMImporter(object):
       self.importTokens(extraName, type, lang)
 
     self.items[type][id] = item
+    self.itemsByName[type].setdefault((item.name, tuple(item.extraNames)), item)
     return dbid
 
   def mapEntityName(self, name, type, extraNames=[]):
@@ -428,9 +537,16 @@ class OSMImporter(object):
       self.importTokens(extraName[1], type, extraName[0])
 
     if extraNames and name in self.items[type]:
+      item = self.items[type][name]
+      oldNameKey = (item.name, tuple(item.extraNames))
       for extraName in extraNames:
-        if extraName not in self.items[type][name].extraNames:
-          self.items[type][name].extraNames.append(extraName)
+        if extraName not in item.extraNames:
+          item.extraNames.append(extraName)
+      newNameKey = (item.name, tuple(item.extraNames))
+      if newNameKey != oldNameKey:
+        if self.itemsByName[type].get(oldNameKey, None) is item:
+          del self.itemsByName[type][oldNameKey]
+        self.itemsByName[type].setdefault(newNameKey, item)
 
     if name in self.itemId2Dbid[type]:
       return self.itemId2Dbid[type][name]
@@ -453,6 +569,7 @@ class OSMImporter(object):
     self.importTokens(name, type, None)
 
     self.items[type][name] = item
+    self.itemsByName[type].setdefault((item.name, tuple(item.extraNames)), item)
     return dbid
 
   def importStreetGeometry(self, osmData):
@@ -470,12 +587,10 @@ class OSMImporter(object):
       self.streetsGeometry[id] = self.packCoordinates(coords)
 
   def importStreetGeometries(self):
-    with closing(gzip.open(self.streetsFile, 'rb')) as f:
-      lineCount = sum(1 for line in f)
-    with closing(gzip.open(self.streetsFile, 'rb')) as f:
-      for line in self.progress(f, total=lineCount):
+    with closing(self.openGzipFile(self.streetsFile)) as f:
+      for line in self.progressGzip(f, self.streetsFile):
         try:
-          data = json.loads(line.decode('utf-8'))
+          data = orjson.loads(line)
         except:
           pass
         self.importStreetGeometry(data)
@@ -495,12 +610,10 @@ class OSMImporter(object):
       self.buildingsGeometry[id] = self.packCoordinates(coords)
 
   def importBuildingGeometries(self):
-    with closing(gzip.open(self.buildingsFile, 'rb')) as f:
-      lineCount = sum(1 for line in f)
-    with closing(gzip.open(self.buildingsFile, 'rb')) as f:
-      for line in self.progress(f, total=lineCount):
+    with closing(self.openGzipFile(self.buildingsFile)) as f:
+      for line in self.progressGzip(f, self.buildingsFile):
         try:
-          data = json.loads(line.decode('utf-8'))
+          data = orjson.loads(line)
         except:
           pass
         self.importBuildingGeometry(data)
@@ -515,33 +628,34 @@ class OSMImporter(object):
 
         encodeStream = encodingstream.DeltaEncodingStream()
         encodeStream.encodeFeature({ 'id': id, 'geometry': item.geometry, 'properties': item.properties })
+        self.accumulateGeomOrigin(item.geometry)
 
         nameId = 0
         if item.name in self.items['name']:
           nameId = self.items['name'][item.name].dbid
         cursor.execute('DELETE FROM entities WHERE country_id IS ? AND region_id IS ? AND county_id IS ? AND locality_id IS ? AND neighbourhood_id IS ? AND street_id IS ? AND (name_id IS NULL OR name_id=?)', (item.dbids.get('country', None), item.dbids.get('region', None), item.dbids.get('county', None), item.dbids.get('locality', None), item.dbids.get('neighbourhood', None), item.dbids.get('street', None), nameId))
-        cursor.execute('INSERT INTO entities(country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, postcode_id, housenumbers, name_id, features, quadindex, rank) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (item.dbids.get('country', None), item.dbids.get('region', None), item.dbids.get('county', None), item.dbids.get('locality', None), item.dbids.get('neighbourhood', None), item.dbids.get('street', None), None, None, None, sqlite3.Binary(encodeStream.getData()), 0, self.calculateItemRank(item)))
+        cursor.execute('INSERT INTO entities(country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, postcode_id, housenumbers, name_id, features, quadindex, rank) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (item.dbids.get('country', None), item.dbids.get('region', None), item.dbids.get('county', None), item.dbids.get('locality', None), item.dbids.get('neighbourhood', None), item.dbids.get('street', None), None, None, None, encodeStream.getData(), 0, self.calculateItemRank(item)))
     cursor.close()
 
+  def accumulateGeomOrigin(self, geometry):
+    try:
+      bounds = calculateGeometryBounds(geometry)
+    except:
+      return
+    if bounds is None:
+      return
+    self.geomFeatureCount += 1
+    self.geomOriginSum[0] += (bounds[0] + bounds[2]) * 0.5
+    self.geomOriginSum[1] += (bounds[1] + bounds[3]) * 0.5
+
   def postProcessFeatures(self):
-    # Calculate origin for geometry
+    # Origin for geometry encoding, averaged over the bounds centers of all
+    # features accumulated during the import
+    if self.geomFeatureCount > 0:
+      geomOrigin = (self.geomOriginSum[0] / self.geomFeatureCount, self.geomOriginSum[1] / self.geomFeatureCount)
+    else:
+      geomOrigin = (0, 0)
     cursor1 = self.db.cursor()
-    cursor1.execute('SELECT features FROM entities')
-    geomOrigin = (0, 0)
-    featureCounter = 0
-    for row in cursor1:
-      encodeStream = encodingstream.DeltaEncodingStream(row[0])
-      while not encodeStream.eof():
-        encodeStream.prevCoord = [0, 0]
-        encodeStream.prevNumber = 0
-        feature = encodeStream.decodeFeature()
-        featureCounter += 1
-        try:
-          bounds = calculateGeometryBounds(feature['geometry'])
-        except:
-          continue
-        origin = ((bounds[0] + bounds[2]) * 0.5, (bounds[1] + bounds[3]) * 0.5)
-        geomOrigin = (geomOrigin[0] + (origin[0] - geomOrigin[0]) / featureCounter, geomOrigin[1] + (origin[1] - geomOrigin[1]) / featureCounter)
 
     # Create inverse mapping lists (dbid -> OSM id)
     itemOsmIds = {}
@@ -555,12 +669,16 @@ class OSMImporter(object):
     rowCount = cursor1.fetchone()[0]
     cursor1.execute('SELECT id, features, housenumbers, country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, postcode_id, housenumbers, name_id FROM entities ORDER BY id')
     cursor2 = self.db.cursor()
+    idFields = [(idx, description[0][:-3]) for idx, description in enumerate(cursor1.description) if description[0].endswith('_id')]
+    updateRows = []
+    deleteRows = []
     for row in self.progress(cursor1, total=rowCount):
       entityId = row[0]
 
       # Read features and housenumbers into interleaved lists
       featureCollections = []
       housenumbers = []
+      housenumberIndices = {}
       featureCounter = 0
       encodeStream = encodingstream.DeltaEncodingStream(row[1])
       while not encodeStream.eof():
@@ -573,11 +691,13 @@ class OSMImporter(object):
 
         if row[2]:
           housenumber = self.normalizeHouseNumber(row[2].split('|')[featureCounter - 1])
-          if housenumber not in housenumbers:
+          index = housenumberIndices.get(housenumber, None)
+          if index is None:
+            housenumberIndices[housenumber] = len(housenumbers)
             housenumbers.append(housenumber)
             featureCollections.append([feature])
           else:
-            featureCollections[housenumbers.index(housenumber)] += [feature]
+            featureCollections[index].append(feature)
         else:
           featureCollections.append([feature])
 
@@ -587,26 +707,44 @@ class OSMImporter(object):
       #    self.housenumRegexBuilder.add(housenumber)
 
       # Try to simplify and merge features
-      for featureCollection in featureCollections:
+      dirty = not self.importIds
+      for k, featureCollection in enumerate(featureCollections):
         if not self.importIds:
-          for i in range(0, len(featureCollection)):
-            featureCollection[i]['id'] = 0
-
-        i = 0
-        while i < len(featureCollection):
-          currentFeature = featureCollection[i]
-          featureIndices = [i + j for j, feature in enumerate(featureCollection[i:]) if feature['id'] == currentFeature['id'] and feature['properties'] == currentFeature['properties']]
-          geometry = mergeGeometries([featureCollection[j]['geometry'] for j in featureIndices]) if len(featureIndices) != 1 else featureCollection[i]['geometry']
-          geometry = simplifyGeometry(geometry, SIMPLIFICATION_FACTOR) if not housenumbers else geometry
-          featureCollection[i] = { 'id': currentFeature['id'], 'geometry': geometry, 'properties': currentFeature['properties'] }
-          for j in reversed(featureIndices[1:]):
-            featureCollection.pop(j)
-          i += 1
-
-      # Encode features
+          for feature in featureCollection:
+            feature['id'] = 0
+
+        # Group features sharing id and properties in a single pass, keeping first-occurrence order
+        featureGroups = {}
+        for feature in featureCollection:
+          featureKey = (feature['id'], tuple(sorted(feature['properties'].items())))
+          if featureKey in featureGroups:
+            featureGroups[featureKey].append(feature)
+          else:
+            featureGroups[featureKey] = [feature]
+        mergedCollection = []
+        for features in featureGroups.values():
+          if len(features) != 1:
+            geometry = mergeGeometries([feature['geometry'] for feature in features])
+            dirty = True
+          else:
+            geometry = features[0]['geometry']
+          if not housenumbers:
+            geometry = simplifyGeometry(geometry, SIMPLIFICATION_FACTOR)
+            dirty = True
+          mergedCollection.append({ 'id': features[0]['id'], 'geometry': geometry, 'properties': features[0]['properties'] })
+        featureCollections[k] = mergedCollection
+
+      # Encode features; a lone untouched feature can reuse its stored
+      # encoding (prefixed with the collection size) when the origin is zero,
+      # since stored features are delta-encoded relative to a zero origin
       encodeStream = encodingstream.DeltaEncodingStream(None, geomOrigin)
-      for featureCollection in featureCollections:
-        encodeStream.encodeFeatureCollection(featureCollection)
+      if not dirty and geomOrigin == (0, 0) and featureCounter == 1 and len(featureCollections) == 1 and len(featureCollections[0]) == 1:
+        encodeStream.encodeNumber(1)
+        encodedData = encodeStream.getData() + row[1]
+      else:
+        for featureCollection in featureCollections:
+          encodeStream.encodeFeatureCollection(featureCollection)
+        encodedData = encodeStream.getData()
 
       # Calculate quadindex of all the geometries
       geometries = []
@@ -616,19 +754,26 @@ class OSMImporter(object):
         bounds = calculateGeometryBounds({ 'type': 'GeometryCollection', 'geometries': geometries })
         quadIndex = quadindex.calculateGeometryQuadIndex(bounds)
       except:
-        cursor2.execute("DELETE FROM entities WHERE id=?", (entityId,))
+        deleteRows.append((entityId,))
         self.warning('Removing entity %d due to illegal geometry' % entityId)
         continue
 
-      for idx, field in [(idx, field) for idx, field in enumerate([description[0] for description in cursor1.description]) if field.endswith('_id')]:
-        type = field[:-3]
+      for idx, type in idFields:
         id = itemOsmIds.get(type, {}).get(row[idx], None)
         if id is not None:
           self.items[type][id].geomBoundsList = mergeBoundsLists(self.items[type][id].geomBoundsList, [bounds])
 
       # Update database
       self.geomBounds = mergeBounds(self.geomBounds, bounds)
-      cursor2.execute('UPDATE entities SET features=?, housenumbers=?, quadindex=? WHERE id=?', (sqlite3.Binary(encodeStream.getData()), '|'.join(housenumbers) if housenumbers else None, quadIndex, entityId))
+      updateRows.append((encodedData, '|'.join(housenumbers) if housenumbers else None, quadIndex, entityId))
+      if len(updateRows) >= 10000:
+        cursor2.executemany('UPDATE entities SET features=?, housenumbers=?, quadindex=? WHERE id=?', updateRows)
+        updateRows = []
+
+    if updateRows:
+      cursor2.executemany('UPDATE entities SET features=?, housenumbers=?, quadindex=? WHERE id=?', updateRows)
+    if deleteRows:
+      cursor2.executemany("DELETE FROM entities WHERE id=?", deleteRows)
 
     if self.geomBounds is not None:
       cursor1.execute("INSERT INTO metadata(name, value) VALUES('bounds', '%.16g,%.16g,%.16g,%.16g')" % self.geomBounds)
@@ -644,7 +789,7 @@ class OSMImporter(object):
     if not 'data' in peliasData:
       self.warning('Entity data is missing')
       return None, None
-    match = re.search('.*[:](\d+).*', peliasData.get('_id', ''))
+    match = ENTITY_ID_PATTERN.search(peliasData.get('_id', ''))
     if not match:
       self.warning('Failed to get entity id')
       return None, None
@@ -754,54 +899,98 @@ class OSMImporter(object):
         self.warning('Geometry entity geometry outside of clip bounds: %d' % id)
         return
 
-    # Try to merge data
+    # Try to merge data. The in-memory index replaces a SELECT over all parent
+    # id columns, candidate rows are only fetched by primary key on a hit
+    mergeKey = (entity.dbids.get('country', None), entity.dbids.get('region', None), entity.dbids.get('county', None), entity.dbids.get('locality', None), entity.dbids.get('neighbourhood', None), entity.dbids.get('street', None), entity.dbids.get('name', None), bool(entity.housenumber))
+    candidateIds = self.mergeIndex.get(mergeKey, [])
+    if candidateIds and mergeKey in self.entityBatchKeys:
+      self.flushEntityBatch()
     cursor = self.db.cursor()
-    cursor.execute('SELECT id, features, housenumbers, postcode_id FROM entities WHERE country_id IS ? AND region_id IS ? AND county_id IS ? AND locality_id IS ? AND neighbourhood_id IS ? AND street_id IS ? AND name_id IS ? AND %s' % ('housenumbers IS NOT NULL' if entity.housenumber else 'housenumbers IS NULL'), (entity.dbids.get('country', None), entity.dbids.get('region', None), entity.dbids.get('county', None), entity.dbids.get('locality', None), entity.dbids.get('neighbourhood', None), entity.dbids.get('street', None), entity.dbids.get('name', None)))
-    for row in cursor:
+    for entityId in candidateIds:
+      cursor.execute('SELECT id, features, housenumbers, postcode_id FROM entities WHERE id=?', (entityId,))
+      row = cursor.fetchone()
       categories = self.loadCategories(row[0])
       if set(categories) != set(data.get('category', [])):
         continue
       encodeStream = encodingstream.DeltaEncodingStream(row[1])
       encodeStream.encodeFeature({ 'id': id, 'geometry': entity.geometry, 'properties': {} })
-      features = sqlite3.Binary(encodeStream.getData())
+      self.accumulateGeomOrigin(entity.geometry)
+      features = encodeStream.getData()
       housenumbers = row[2] + '|' + entity.housenumber.replace('|', ' ') if entity.housenumber else None
       cursor.execute('UPDATE entities SET features=?, housenumbers=?, postcode_id=? WHERE id=?', (features, housenumbers, row[3] or entity.dbids.get('postcode', None), row[0]))
       cursor.close()
       return
 
-    # Merging not possible, store
+    # Merging not possible, store. Ids are assigned explicitly so that the
+    # inserts can be buffered and flushed in large batches
     encodeStream = encodingstream.DeltaEncodingStream()
     encodeStream.encodeFeature({ 'id': id, 'geometry': entity.geometry, 'properties': {} })
-    features = sqlite3.Binary(encodeStream.getData())
+    self.accumulateGeomOrigin(entity.geometry)
+    features = encodeStream.getData()
     housenumbers = entity.housenumber.replace('|', ' ') if entity.housenumber else None
-    cursor.execute('INSERT INTO entities(country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, postcode_id, name_id, housenumbers, features, quadindex, rank) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (entity.dbids.get('country', None), entity.dbids.get('region', None), entity.dbids.get('county', None), entity.dbids.get('locality', None), entity.dbids.get('neighbourhood', None), entity.dbids.get('street', None), entity.dbids.get('postcode', None), entity.dbids.get('name', None), housenumbers, features, 0, self.calculateEntityRank(entity)))
-    self.storeCategories(cursor.lastrowid, data.get('category', []))
+    self.entityIdCounter += 1
+    self.entityBatch.append((self.entityIdCounter, entity.dbids.get('country', None), entity.dbids.get('region', None), entity.dbids.get('county', None), entity.dbids.get('locality', None), entity.dbids.get('neighbourhood', None), entity.dbids.get('street', None), entity.dbids.get('postcode', None), entity.dbids.get('name', None), housenumbers, features, 0, self.calculateEntityRank(entity)))
+    self.entityBatchKeys.add(mergeKey)
+    self.mergeIndex.setdefault(mergeKey, []).append(self.entityIdCounter)
+    if len(self.entityBatch) >= 10000:
+      self.flushEntityBatch()
+    self.storeCategories(self.entityIdCounter, data.get('category', []))
     cursor.close()
 
-  def importPeliasData(self):
-    # Count number of lines
-    with closing(gzip.open(self.addressesFile, 'rb')) as f:
-      lineCount = sum(1 for line in f)
+  def parsePeliasFile(self, fileName):
+    # A reader thread decompresses the file and submits parse chunks to the
+    # worker pool, so decompression, JSON parsing and the SQLite work on the
+    # consuming thread all overlap. The bounded queue keeps only a few chunks
+    # in flight instead of reading the whole file into memory
+    with closing(self.openGzipFile(fileName)) as f:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=PELIAS_PARSE_WORKERS) as executor:
+        pendingChunks = queue.Queue(maxsize=2 * PELIAS_PARSE_WORKERS)
+        readErrors = []
+        def readChunks():
+          try:
+            chunk = []
+            for line in self.progressGzip(f, fileName):
+              chunk.append(line)
+              if len(chunk) >= PELIAS_PARSE_CHUNK_SIZE:
+                pendingChunks.put(executor.submit(parsePeliasChunk, chunk))
+                chunk = []
+            if chunk:
+              pendingChunks.put(executor.submit(parsePeliasChunk, chunk))
+          except BaseException as e:
+            readErrors.append(e)
+          finally:
+            pendingChunks.put(None)
+        reader = threading.Thread(target=readChunks, daemon=True)
+        reader.start()
+        while True:
+          future = pendingChunks.get()
+          if future is None:
+            break
+          for peliasData in future.result():
+            yield peliasData
+        reader.join()
+        if readErrors:
+          raise readErrors[0]
+
+  def flushEntityBatch(self):
+    if self.entityBatch:
+      cursor = self.db.cursor()
+      cursor.executemany('INSERT INTO entities(id, country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, postcode_id, name_id, housenumbers, features, quadindex, rank) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self.entityBatch)
+      cursor.close()
+    self.entityBatch = []
+    self.entityBatchKeys = set()
 
+  def importPeliasData(self):
     # Create spatial index of buildings
     buildingsLocator = buildingslocator.BuildingsLocator(self.db)
     buildingsLocator.initialize()
-    with closing(gzip.open(self.addressesFile, 'rb')) as f:
-      for line in self.progress(f, total=lineCount):
-        try:
-          peliasData = json.loads(line.decode('utf-8'))
-        except:
-          pass
-        self.importPeliasBuilding(peliasData, buildingsLocator)
+    for peliasData in self.parsePeliasFile(self.addressesFile):
+      self.importPeliasBuilding(peliasData, buildingsLocator)
 
     # Do actual importing, then drop the spatial index
-    with closing(gzip.open(self.addressesFile, 'rb')) as f:
-      for line in self.progress(f, total=lineCount):
-        try:
-          peliasData = json.loads(line.decode('utf-8'))
-        except:
-          pass
-        self.importPeliasAddress(peliasData, buildingsLocator)
+    for peliasData in self.parsePeliasFile(self.addressesFile):
+      self.importPeliasAddress(peliasData, buildingsLocator)
+    self.flushEntityBatch()
     buildingsLocator.finish()
 
   def importPelias(self):
@@ -816,7 +1005,6 @@ class OSMImporter(object):
 
     self.importMetadata()
 
-    self.db.execute("CREATE INDEX entities_all ON entities (country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, postcode_id, name_id)")
     self.db.execute("CREATE INDEX entitycategories_entity_id ON entitycategories (entity_id)")
 
     if self.streetsFile is not None:
@@ -832,11 +1020,14 @@ class OSMImporter(object):
 
     if self.importWOF:
       self.info('Importing WhosOnFirst geometry')
+      # The parent id index is only needed for the WOF replacement DELETEs;
+      # building it here avoids maintaining it during the bulk address inserts
+      self.db.execute("CREATE INDEX entities_all ON entities (country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, postcode_id, name_id)")
       self.importWOFGeometries()
 
     self.db.commit()
 
-    self.db.execute("DROP INDEX entities_all")
+    self.db.execute("DROP INDEX IF EXISTS entities_all")
     self.db.execute("DROP INDEX entitycategories_entity_id")
 
     self.db.execute("BEGIN")
@@ -862,46 +1053,49 @@ class OSMImporter(object):
     cursor1 = self.db.cursor()
     cursor2 = self.db.cursor()
 
-    # Set type
+    # Set type, most specific class first like the old per-row ladder
     cursor.execute("ALTER TABLE entities ADD type INTEGER NOT NULL DEFAULT 0")
-
-    cursor1.execute("SELECT COUNT(*) FROM entities")
-    rowCount = cursor1.fetchone()[0]
-    cursor1.execute("SELECT rowid, housenumbers, country_id, region_id, county_id, locality_id, neighbourhood_id, street_id, NULL, name_id FROM entities")
-    for row in self.progress(cursor1, total=rowCount):
-      if row[-1]:
-        type = CLASS_TABLE['name']
-      elif row[1]:
-        type = CLASS_TABLE['housenumber']
-      elif row[-3]:
-        type = CLASS_TABLE['street']
-      elif row[-4]:
-        type = CLASS_TABLE['neighbourhood']
-      elif row[-5]:
-        type = CLASS_TABLE['locality']
-      elif row[-6]:
-        type = CLASS_TABLE['county']
-      elif row[-7]:
-        type = CLASS_TABLE['region']
-      elif row[-8]:
-        type = CLASS_TABLE['country']
-      cursor.execute("UPDATE entities SET type=? WHERE rowid=?", (type, row[0]))
+    cursor.execute("""UPDATE entities SET type=CASE
+      WHEN name_id IS NOT NULL THEN %d
+      WHEN housenumbers IS NOT NULL THEN %d
+      WHEN street_id IS NOT NULL THEN %d
+      WHEN neighbourhood_id IS NOT NULL THEN %d
+      WHEN locality_id IS NOT NULL THEN %d
+      WHEN county_id IS NOT NULL THEN %d
+      WHEN region_id IS NOT NULL THEN %d
+      WHEN country_id IS NOT NULL THEN %d
+      ELSE 0 END""" % (CLASS_TABLE['name'], CLASS_TABLE['housenumber'], CLASS_TABLE['street'], CLASS_TABLE['neighbourhood'], CLASS_TABLE['locality'], CLASS_TABLE['county'], CLASS_TABLE['region'], CLASS_TABLE['country']))
 
     # Store name info in separate entitynames table
     cursor.execute("CREATE TABLE entitynames (entity_id INTEGER NOT NULL, name_id INTEGER NOT NULL)")
     for idx, field in enumerate(['country', 'region', 'county', 'locality', 'neighbourhood', 'street', 'postcode', 'name']):
       cursor.execute("INSERT INTO entitynames(entity_id, name_id) SELECT id, %s_id FROM entities WHERE %s_id IS NOT NULL" % (field, field))
 
-    # Add entitycount field to names
+    # Add entitycount field to names. A single grouped scan replaces the
+    # correlated COUNT(*) subquery per name; rows without entities keep the
+    # column default of 0
     cursor.execute("CREATE INDEX entitynames_entity_name_id ON entitynames(entity_id, name_id)")
     cursor.execute("CREATE INDEX entitynames_name_id ON entitynames(name_id)")
     cursor.execute("ALTER TABLE names ADD entitycount INTEGER NOT NULL DEFAULT 0")
-    cursor.execute("UPDATE names SET entitycount=(SELECT COUNT(*) FROM entitynames WHERE entitynames.name_id=names.id)")
+    cursor.execute("CREATE TEMP TABLE entityname_counts AS SELECT name_id, COUNT(*) AS cnt FROM entitynames GROUP BY name_id")
+    cursor.execute("CREATE INDEX temp.entityname_counts_name_id ON entityname_counts(name_id)")
+    cursor.execute("UPDATE names SET entitycount=(SELECT cnt FROM entityname_counts WHERE entityname_counts.name_id=names.id) WHERE id IN (SELECT name_id FROM entityname_counts)")
+    cursor.execute("DROP TABLE entityname_counts")
 
     # Add namecount field to tokens
     cursor.execute("CREATE INDEX nametokens_token_name_id ON nametokens (token_id, name_id)")
     cursor.execute("ALTER TABLE tokens ADD namecount INTEGER NOT NULL DEFAULT 0")
-    cursor.execute("UPDATE tokens SET namecount=(SELECT COUNT(*) FROM nametokens WHERE nametokens.token_id=tokens.id)")
+    cursor.execute("CREATE TEMP TABLE nametoken_counts AS SELECT token_id, COUNT(*) AS cnt FROM nametokens GROUP BY token_id")
+    cursor.execute("CREATE INDEX temp.nametoken_counts_token_id ON nametoken_counts(token_id)")
+    cursor.execute("UPDATE tokens SET namecount=(SELECT cnt FROM nametoken_counts WHERE nametoken_counts.token_id=tokens.id) WHERE id IN (SELECT token_id FROM nametoken_counts)")
+    cursor.execute("DROP TABLE nametoken_counts")
+
+    # Token text to ids, replaces a SELECT per tokenized word below. A token
+    # text can map to several ids (abbreviations), in ascending id order
+    tokensMap = {}
+    cursor1.execute("SELECT token, id FROM tokens")
+    for row1 in cursor1:
+      tokensMap.setdefault(row1[0], []).append(row1[1])
 
     # Update housenumbers
     names = {}
@@ -914,6 +1108,7 @@ class OSMImporter(object):
     cursor1.execute("SELECT COUNT(*) FROM old_entities")
     rowCount = cursor1.fetchone()[0]
     cursor1.execute("SELECT id, type, quadindex, rank, housenumbers, features FROM old_entities")
+    nameTokenRows = []
     for row1 in self.progress(cursor1, total=rowCount):
       encodeStream = encodingstream.DeltaEncodingStream()
       if row1[4]:
@@ -924,11 +1119,15 @@ class OSMImporter(object):
             names[houseNum] = nameId
             cursor.execute("INSERT INTO names(id, lang, name, type) VALUES(?, ?, ?, ?)", (nameId, None, houseNum, 9))
             for token in self.tokenizeName(houseNum):
-              cursor2.execute("SELECT id FROM tokens WHERE token=?", (token,))
-              for row2 in cursor2:
-                cursor.execute("INSERT INTO nametokens(name_id, token_id) VALUES(?, ?)", (nameId, row2[0]))
+              for tokenId in tokensMap.get(token, []):
+                nameTokenRows.append((nameId, tokenId))
+            if len(nameTokenRows) >= 10000:
+              cursor.executemany("INSERT INTO nametokens(name_id, token_id) VALUES(?, ?)", nameTokenRows)
+              nameTokenRows = []
           encodeStream.encodeNumber(names[houseNum])
-      cursor.execute("INSERT INTO entities(id, type, quadindex, rank, features, housenumbers) VALUES(?, ?, ?, ?, ?, ?)", (row1[0], row1[1], row1[2], int(row1[3] * RANK_SCALE), row1[5], sqlite3.Binary(encodeStream.getData()) if encodeStream.getData() else None))
+      cursor.execute("INSERT INTO entities(id, type, quadindex, rank, features, housenumbers) VALUES(?, ?, ?, ?, ?, ?)", (row1[0], row1[1], row1[2], int(row1[3] * RANK_SCALE), row1[5], encodeStream.getData() or None))
+    if nameTokenRows:
+      cursor.executemany("INSERT INTO nametokens(name_id, token_id) VALUES(?, ?)", nameTokenRows)
 
     cursor.execute("DROP TABLE old_entities")
 
@@ -937,9 +1136,16 @@ class OSMImporter(object):
     cursor1.execute("SELECT id, name, lang FROM names WHERE id IN (SELECT id FROM names WHERE lang IS NOT NULL)")
     rows1 = cursor1.fetchall()
     cursor.execute("DELETE FROM nametokens WHERE name_id IN (SELECT id FROM names WHERE lang IS NOT NULL)")
+    langTokenRows = []
     for row1 in rows1:
       for token in self.tokenizeName(row1[1]):
-        cursor.execute("INSERT INTO nametokens(name_id, token_id, lang) SELECT ?, id, ? FROM tokens WHERE token=?", (row1[0], row1[2], token))
+        for tokenId in tokensMap.get(token, []):
+          langTokenRows.append((row1[0], tokenId, row1[2]))
+      if len(langTokenRows) >= 10000:
+        cursor.executemany("INSERT INTO nametokens(name_id, token_id, lang) VALUES(?, ?, ?)", langTokenRows)
+        langTokenRows = []
+    if langTokenRows:
+      cursor.executemany("INSERT INTO nametokens(name_id, token_id, lang) VALUES(?, ?, ?)", langTokenRows)
 
     # Indices
     cursor.execute("DROP INDEX nametokens_token_id")
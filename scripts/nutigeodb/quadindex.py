@@ -1,5 +1,4 @@
 import math
-import shapely.ops
 import shapely.geometry
 
 EARTH_R = 6378137
@@ -49,25 +48,32 @@ def calculateTileQuadIndex(zoom, xt, yt):
   return zoom + (((yt << zoom) + xt) << LEVEL_BITS)
 
 def calculateGeometryQuadIndex(bounds):
+  # Closed form of the old per-level descent: map both corners to pixel
+  # coordinates at MAX_LEVEL, the deepest tile containing the whole geometry
+  # then follows from the common bit prefix of the two pixel pairs. Matching
+  # the boundsIntersect convention, a coordinate exactly on a tile edge
+  # belongs to the tile below/left of it
   geomBounds = calculateWMBounds(bounds)
-  tile = (0, 0, 0)
-  while tile[0] < MAX_LEVEL:
-    hitSubTiles = []
-    for i in range(0, 4):
-      subTile = (tile[0] + 1, tile[1] * 2 + i // 2, tile[2] * 2 + i % 2)
-      subTileBounds = calculateTileBounds(*subTile)
-      if boundsIntersect(subTileBounds, geomBounds):
-        hitSubTiles.append(subTile)
-    if len(hitSubTiles) != 1:
-      break
-    tile = hitSubTiles[0]
-  return calculateTileQuadIndex(*tile)
+  d = EARTH_R * math.pi
+  s = 2 * d / (1 << MAX_LEVEL)
+  px0 = math.ceil((geomBounds[0] + d) / s) - 1
+  py0 = math.ceil((geomBounds[1] + d) / s) - 1
+  px1 = math.ceil((geomBounds[2] + d) / s) - 1
+  py1 = math.ceil((geomBounds[3] + d) / s) - 1
+  maxTile = (1 << MAX_LEVEL) - 1
+  if px1 < 0 or py1 < 0 or px0 > maxTile or py0 > maxTile:
+    return calculateTileQuadIndex(0, 0, 0)
+  px0, py0 = max(px0, 0), max(py0, 0)
+  px1, py1 = min(px1, maxTile), min(py1, maxTile)
+  level = MAX_LEVEL - ((px0 ^ px1) | (py0 ^ py1)).bit_length()
+  return calculateTileQuadIndex(level, px0 >> (MAX_LEVEL - level), py0 >> (MAX_LEVEL - level))
 
 def findGeometries(x, y, radius, geomQuery):
   xm, ym = wgs2wm(x, y)
   maxDist = radius / math.cos(y * math.pi / 180.0)
 
   results = []
+  point = shapely.geometry.Point(xm, ym)
   tileCount, geomCount = 0, 0
   for level in range(MAX_LEVEL, -1, -1):
     tile0 = calculatePointTile(xm - maxDist, ym - maxDist, level)
@@ -76,9 +82,8 @@ def findGeometries(x, y, radius, geomQuery):
     tileCount += len(quadIndices)
     for id, geom in geomQuery(quadIndices):
       geomCount += 1
-      geomTransformed = shapely.ops.transform(lambda x, y: transform(inProj, outProj, x, y), geom)
-      dist = shapely.geometry.Point(xm, ym).distance(geomTransformed)
+      dist = point.distance(geom)
       if dist <= maxDist:
         results.append((dist, id))
-  results.sort(lambda result1, result2: cmp(result1[0], result2[0]))
+  results.sort(key=lambda result: result[0])
   return results
@@ -1,26 +1,29 @@
 import re
+import numpy as np
 
 class RegexBuilder(object):
   def __init__(self):
     self.charSetsMap = {}
 
   def add(self, sample):
-    if isinstance(sample, unicode):
+    if isinstance(sample, str):
       sample = sample.encode('utf8')
-    charSets = self.charSetsMap.get(len(sample), [set() for c in sample])
-    for i, c in enumerate(sample):
-      charSets[i].add(c)
-    self.charSetsMap[len(sample)] = charSets
+    charSets = self.charSetsMap.get(len(sample), None)
+    if charSets is None:
+      charSets = np.zeros((len(sample), 256), dtype=bool)
+      self.charSetsMap[len(sample)] = charSets
+    charSets[np.arange(len(sample)), np.frombuffer(sample, dtype=np.uint8)] = True
 
   def build(self):
     regexes = []
     for n, charSets in self.charSetsMap.items():
       regex = ""
-      for charSet in charSets:
+      for row in charSets:
         chars = []
-        for c in sorted(list(charSet)):
-          if c.isalnum() or c in [' ', '-']:
-            chars.append(c.lower())
+        for c in np.flatnonzero(row):
+          ch = chr(c)
+          if (c < 128 and ch.isalnum()) or ch in (' ', '-'):
+            chars.append(ch.lower())
           else:
             chars = None
             break
@@ -3,33 +3,48 @@ import shapely
 import shapely.prepared
 import shapely.geometry
 import sqlite3
+from collections import OrderedDict
+
+CACHE_SIZE = 2048
 
 class WOFLocator(object):
   def __init__(self, db, placetypes):
     self.db = db
     self.cursor = self.db.cursor()
     self.placetypes = placetypes
-    self.geoJSONCache = {}
-    self.hierarchyCache = {}
+    # LRU caches; prepared country polygons can run into hundreds of MB, so
+    # both caches are bounded instead of growing with the whole WOF database
+    self.geoJSONCache = OrderedDict()
+    self.hierarchyCache = OrderedDict()
 
   def findGeoJSON(self, id):
-    if id not in self.geoJSONCache:
-      self.cursor.execute("SELECT body FROM geojson WHERE id=?", (id,))
-      row = self.cursor.fetchone()
-      geojson = json.loads(row[0]) if row else { 'type': 'Feature', 'geometry': { 'type': 'GeometryCollection', 'geometries': [] } }
-      self.geoJSONCache[id] = geojson
-    return self.geoJSONCache.get(id, None)
+    geojson = self.geoJSONCache.get(id, None)
+    if geojson is not None:
+      self.geoJSONCache.move_to_end(id)
+      return geojson
+    self.cursor.execute("SELECT body FROM geojson WHERE id=?", (id,))
+    row = self.cursor.fetchone()
+    geojson = json.loads(row[0]) if row else { 'type': 'Feature', 'geometry': { 'type': 'GeometryCollection', 'geometries': [] } }
+    self.geoJSONCache[id] = geojson
+    while len(self.geoJSONCache) > CACHE_SIZE:
+      self.geoJSONCache.popitem(last=False)
+    return geojson
 
   def getGeometryAndHierarchy(self, id):
-    if id not in self.hierarchyCache:
-      self.cursor.execute("SELECT body FROM geojson WHERE id=?", (id,))
-      body = self.cursor.fetchone()[0]
-      geojson = json.loads(body)
-      geometry = shapely.prepared.prep(shapely.geometry.asShape(geojson['geometry']))
-      hierarchy = []
-      for places in geojson['properties'].get('wof:hierarchy', []):
-        hierarchy.append({ key: val for key, val in places.items() if key.endswith('_id') and key[:-3] in self.placetypes })
-      self.hierarchyCache[id] = (geometry, hierarchy)
+    cached = self.hierarchyCache.get(id, None)
+    if cached is not None:
+      self.hierarchyCache.move_to_end(id)
+      return cached
+    self.cursor.execute("SELECT body FROM geojson WHERE id=?", (id,))
+    body = self.cursor.fetchone()[0]
+    geojson = json.loads(body)
+    geometry = shapely.prepared.prep(shapely.geometry.shape(geojson['geometry']))
+    hierarchy = []
+    for places in geojson['properties'].get('wof:hierarchy', []):
+      hierarchy.append({ key: val for key, val in places.items() if key.endswith('_id') and key[:-3] in self.placetypes })
+    self.hierarchyCache[id] = (geometry, hierarchy)
+    while len(self.hierarchyCache) > CACHE_SIZE:
+      self.hierarchyCache.popitem(last=False)
     return self.hierarchyCache[id]
 
   def getHierarchy(self, id):
@@ -42,8 +57,9 @@ class WOFLocator(object):
       if current and placetype in self.placetypes:
         parents.append((id, placetype))
     parents.sort(key=lambda parent: -self.placetypes.index(parent[1]))
+    point = shapely.geometry.Point(*pos)
     for id, placetype in parents:
       geometry, hierarchy = self.getGeometryAndHierarchy(id)
-      if geometry.contains(shapely.geometry.Point(*pos)):
+      if geometry.contains(point):
         return hierarchy
     return []
@@ -3,19 +3,23 @@ import argparse
 import os
 import os.path
 import json
+import numpy as np
 from shapely.geometry import Polygon, mapping
-import functools
 
 def read_polygon(polygon_filename):
   with open(polygon_filename) as f:
     return f.readlines()
 
 def clean_polygon(polygon_data):
-  coordinates = polygon_data[2:][:-2]
-  coordinates = [re.split(r'[\s\t]+', item) for item in coordinates]
-  coordinates = [list(filter(None, item)) for item in coordinates]
-  coordinates = functools.reduce(lambda a,b: a[-1].pop(0) and a if len(a[-1]) == 1 and a[-1][0] == 'END' else a.append(['END']) or a if b[0].startswith('END') else a[-1].append(b) or a, [[[]]] + coordinates)
-  coordinates = [[(float(item[0]), float(item[1])) for item in coordgroup] for coordgroup in coordinates]
+  # Drop the name line, split sections at END lines, drop each section header
+  text = ''.join(polygon_data[1:])
+  coordinates = []
+  for block in re.split(r'(?m)^END\s*$', text):
+    lines = block.strip().split('\n', 1)
+    if len(lines) < 2:
+      continue
+    values = np.fromiter(lines[1].split(), dtype=np.float64)
+    coordinates.append([tuple(point) for point in values.reshape(-1, 2)])
   return coordinates
 
 def write_geojson(data, geojson_filename):
@@ -23,6 +23,10 @@ class Transformer(object):
     self._inverse = inverse
 
   def transform(self, x, y):
+    if isinstance(x, (list, tuple)):
+      convert = _wgs84ToWebMercator if self._inverse else _webMercatorToWgs84
+      points = [convert(point) for point in zip(x, y)]
+      return [point[0] for point in points], [point[1] for point in points]
     if self._inverse:
       return _wgs84ToWebMercator((x, y))
     else: